@@ -8,6 +8,12 @@
 # The programming was done so that ELP calculation algorithms used Kpre and vergence formula algo- rithms used Kpost. The modified formula is shown in the Appendix. Independent variables were AL, Kpre, Kpost, and the A-constant of the IOL.
 
 # Double-K SRK/T Formula
+#
+# 下面按照文献附录, 一个方程一个函数. 每个函数只接收它那个方程里直接出现的量, 输入可以是标量, 也可以是numpy数组.
+# 最后由 `trace` 按顺序把每个方程算一次, 所有中间结果都保留下来, 可以逐步检查.
+#
+# 注意: 文献里印出来的常数是四舍五入过的(-5.41, 3.336), 这里用SRK/T原始的常数(-5.40948, 3.3357),
+# 与 compute_IOL.py 中的 Double_K_SRK_T 保持一致.
 
 # In[12]:
 
@@ -30,20 +36,17 @@ def r_pre(K_pre):
 
 
 # ## Equation 2: Corrected axial length (LCOR):
-# 
-# If $L \le 24.2$, $ LCOR = L$ 
-# 
+#
+# If $L \le 24.2$, $ LCOR = L$
+#
 # If $L \gt 24.2$, $ LCOR = -3.446 + 1.716 \times L - 0.0237 \times L^2$
-# 
+#
 
 # In[2]:
 
 
 def LCOR(L):
-    if L <=24.2:
-        return L
-    else:
-        return -3.446+1.716*𝐿-0.0237*(L**2)
+    return np.where(L <= 24.2, L, -3.446+1.716*L-0.0237*(L**2))
 
 
 # ## Equation 3: Computed corneal width (Cw):
@@ -55,8 +58,8 @@ def LCOR(L):
 # In[9]:
 
 
-def Cw(L, K_pre):
-    return -5.41+0.58412* LCOR(L)+0.098*K_pre
+def Cw(L_cor, K_pre):
+    return -5.40948+0.58412*L_cor+0.098*K_pre
 
 
 # ## Equation 4: Corneal height (H):
@@ -69,16 +72,14 @@ def Cw(L, K_pre):
 # H = r_{pre} - \sqrt {r_{pre}^2 - (Cw^2/4)}
 # \tag {4.1}
 # $$
+# 被开方的数小于0时, 与IOL Master一样, 强制=0.
 
 # In[26]:
 
 
-def H(L, K_pre):
-    r=r_pre(K_pre)
-    c=Cw(L,K_pre)
-    rc=r**2-(c**2/4) if (r**2-(c**2/4))>=0 else 0
-    return r-np.sqrt(r**2-(c**2/4))
-    
+def H(r, c):
+    rc=np.maximum(r**2-(c**2/4), 0)
+    return r-np.sqrt(rc)
 
 
 # ## Equation 5: Offset value:
@@ -86,12 +87,17 @@ def H(L, K_pre):
 # \text { Offset }=\mathrm{ACD}_{\text {const }}-3.336
 # \tag 5
 # $$
+#
+# 其中 ACD const 由A常数换算: $ACD_{const} = 0.62467 \times A - 68.74709$
 
 # In[15]:
 
 
+def ACD_const(A):
+    return 0.62467*A-68.74709
+
 def offset(ACD_const):
-    return ACD_const-3.336
+    return ACD_const-3.3357
 
 
 # ## Equation 6: Estimated postoperative ELP (ACD):
@@ -103,8 +109,8 @@ def offset(ACD_const):
 # In[16]:
 
 
-def ACD_est(L,K_pre, ACD_const):
-    return H(L,K_pre)+offset(ACD_const)
+def ACD_est(H, offset):
+    return H+offset
 
 
 # ## Equation 7: Constants:
@@ -117,6 +123,7 @@ def ACD_est(L,K_pre, ACD_const):
 
 
 def get_constants():
+    constants={}
     constants["V"]=12
     constants["n_a"]=1.336
     constants["n_c"]=1.333
@@ -135,8 +142,8 @@ def get_constants():
 
 def RETHICK(L):
     return 0.65696 - 0.02029*L
-def LOPT(L):
-    return L+RETHICK(L)
+def LOPT(L, RETHICK):
+    return L+RETHICK
 
 
 # ## Equation 9: Postoperative corneal radius of curvature:
@@ -158,29 +165,100 @@ def r_post(K_post):
 # $$
 # IOL_{emme}= \frac {1000 \times n_a \times ( n \times r_{post} -n_cm1 \times LOPT)} {(LOPT-ACD_{est}) \times (n_a \times r_{post} -n_cm1 \times ACD_{est})}
 # $$
+#
+# 公式里的 n 就是 $n_a$. 把分子分母拆成SRK/T里的S1~S5, S4, S5 在计算目标屈光度REFt对应的IOL度数时用到:
+# $$
+# IOL_{REFt}= \frac {1000 \times n_a \times (S3 - 0.001 \times REFt \times S4)} {S1 \times (S2 - 0.001 \times REFt \times S5)}
+# $$
 
 # In[ ]:
 
 
-def S(L,K_pre,K_post,ACD_const):
-    S1=LOPT()-ACD_est
+def S(LOPT, ACD_est, r_post, constants=None):
+    if constants is None:
+        constants=get_constants()
+    n_a=constants["n_a"]; c2=constants["n_c_m1"]; V=constants["V"]
+    S1=LOPT-ACD_est
     S2=n_a*r_post-c2*ACD_est
     S3=n_a*r_post-c2*LOPT
     S4=V*S3+LOPT*r_post
     S5=V*S2+ACD_est*r_post
+    return S1, S2, S3, S4, S5
 
 
 # In[25]:
 
 
-def IOL_emme(L,K_pre,K_post,ACD_const):
+def IOL_emme(S1, S2, S3, constants=None):
+    if constants is None:
+        constants=get_constants()
+    return 1000*constants["n_a"]*S3/(S1*S2)
+
+
+def IOL_for_target(S1, S2, S3, S4, S5, REFt, constants=None):
+    if constants is None:
+        constants=get_constants()
+    return 1000*constants["n_a"]*(S3-0.001*REFt*S4)/(S1*(S2-0.001*REFt*S5))
+
+
+# ## 逐步计算
+#
+# 每个方程只算一次, 返回所有中间结果. `trace(...)["IOL"]` 就是目标屈光度对应的IOL度数.
+
+# In[ ]:
+
+
+def trace(L, K_pre, K_post, A, REFt=0):
+    L=np.asarray(L, dtype=np.float64)
+    K_pre=np.asarray(K_pre, dtype=np.float64)
+    K_post=np.asarray(K_post, dtype=np.float64)
     constants=get_constants()
-    n_a=constants["n_a"]
-    n = constants["n_a"] # who knows what is n ??? 
-    n_cm1=constants["n_cm1"]
-    numerator=1000*n_a*( n*r_post(K_post) -n_cm1*LOPT(L) )
-    denominator=( LOPT(L)-ACD_est(L,K_pre, ACD_const) ) *                 (n_a*r_post(K_post) -n_cm1*ACD_est(L,K_pre, ACD_const) )
-    return numerator/denominator
+    t={}
+    t["r_pre"]=r_pre(K_pre)
+    t["LCOR"]=LCOR(L)
+    t["Cw"]=Cw(t["LCOR"], K_pre)
+    t["H"]=H(t["r_pre"], t["Cw"])
+    t["ACD_const"]=ACD_const(np.asarray(A, dtype=np.float64))
+    t["offset"]=offset(t["ACD_const"])
+    t["ACD_est"]=ACD_est(t["H"], t["offset"])
+    t["RETHICK"]=RETHICK(L)
+    t["LOPT"]=LOPT(L, t["RETHICK"])
+    t["r_post"]=r_post(K_post)
+    S1, S2, S3, S4, S5=S(t["LOPT"], t["ACD_est"], t["r_post"], constants)
+    t.update(S1=S1, S2=S2, S3=S3, S4=S4, S5=S5)
+    t["IOL_emme"]=IOL_emme(S1, S2, S3, constants)
+    t["IOL"]=IOL_for_target(S1, S2, S3, S4, S5, np.asarray(REFt, dtype=np.float64), constants)
+    return t
+
+
+def Double_K_SRK_T(AL, Kpre, Kpost, A, REFt):
+    return trace(AL, Kpre, Kpost, A, REFt)["IOL"]
+
+
+# ## 与 compute_IOL.py 对照
+#
+# 随机生成一大批数据, 与 compute_IOL.Double_K_SRK_T 比较. 标量版本逐行计算很慢, 只抽 `n_scalar` 行比较;
+# 全部数据与 batch_IOL 中的数组版本比较.
+
+# In[ ]:
+
+
+def verify(n=1000000, n_scalar=10000, seed=0):
+    import compute_IOL
+    import batch_IOL
+    rng=np.random.default_rng(seed)
+    AL=rng.uniform(18, 34, n)
+    Kpre=rng.uniform(38, 50, n)
+    Kpost=Kpre-rng.uniform(0, 8, n)
+    A=rng.uniform(115, 121, n)
+    REFt=rng.uniform(-3, 1, n)
+    t=trace(AL, Kpre, Kpost, A, REFt)
+    batch_error=np.max(np.abs(t["IOL"]-batch_IOL.Double_K_SRK_T(AL, Kpre, Kpost, A, REFt)))
+    idx=rng.choice(n, size=min(n_scalar, n), replace=False)
+    scalar=np.array([compute_IOL.Double_K_SRK_T(AL[i], Kpre[i], Kpost[i], A[i], REFt[i]) for i in idx])
+    scalar_error=np.max(np.abs(t["IOL"][idx]-scalar))
+    return {"rows": n, "max_error_vs_batch": float(batch_error),
+            "scalar_rows": len(idx), "max_error_vs_scalar": float(scalar_error)}
 
 
 # In[ ]:
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # IOL 计算结果缓存
+#
+# 同一批病例重新跑一遍的时候, 大部分公式其实没有改过, 没必要全部重算.
+# 这里把计算结果存到磁盘上的SQLite文件里, key 是
+#
+# * 公式的名字 (连同所在的模块, 比如 `compute_IOL.SRK_T` 和 `batch_IOL.SRK_T` 是两个公式)
+# * 公式的版本戳: 公式源代码(连同它调用的同一个模块里的其他公式)的hash
+# * 规范化以后的输入参数
+#
+# 三者合起来的hash. 只要公式的代码没改, 输入一样, 就直接从磁盘读结果; 改过的公式版本戳变了, 自动重算.
+
+# In[ ]:
+
+
+import hashlib
+import importlib
+import inspect
+import io
+import json
+import sqlite3
+import time
+
+import numpy as np
+
+import compute_IOL
+
+
+# ## 公式版本戳
+#
+# 用源代码的hash作为版本. BESST 内部会调用 SRK_T 和 HOFFER_Q, 所以要把同一个模块里被调用到的函数也算进去,
+# 否则改了 SRK_T, BESST 的缓存却还是旧的. 函数里用到的模块级常数(比如 batch_IOL.LATKANY 的系数,
+# N_POST 的折射率, 当前的计算精度 _dtype)也算进去: 源代码不变, 常数改了, 版本也要变.
+# 源代码部分一个进程里只算一次; 常数每次都重新取值, 因为 set_precision 这类函数会在运行中修改它们.
+
+# In[ ]:
+
+
+def _code_names(code):
+    # 函数体里用到的名字, 包括其中的列表推导式、lambda
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if inspect.iscode(c):
+            names |= _code_names(c)
+    return names
+
+
+def _formula_dependencies(func, seen=None):
+    if seen is None:
+        seen = {}
+    name = func.__module__ + "." + func.__qualname__
+    if name in seen:
+        return seen
+    seen[name] = func
+    module_globals = getattr(func, "__globals__", {})
+    for n in sorted(_code_names(func.__code__)):
+        g = module_globals.get(n)
+        if inspect.isfunction(g) and g.__module__ == func.__module__:
+            _formula_dependencies(g, seen)
+    return seen
+
+
+def _constant_names(deps):
+    # 被用到的模块级常数: 不是函数、不是模块的全局变量
+    names = set()
+    for f in deps.values():
+        for n in _code_names(f.__code__):
+            if n in f.__globals__:
+                g = f.__globals__[n]
+                if not (inspect.ismodule(g) or inspect.isfunction(g) or inspect.isbuiltin(g)):
+                    names.add((f.__module__, n))
+    return sorted(names)
+
+
+def _constant_text(v):
+    if isinstance(v, np.ndarray):
+        return "%s%s:%s" % (v.dtype, v.shape, hashlib.sha256(np.ascontiguousarray(v).tobytes()).hexdigest())
+    return repr(v)
+
+
+def formula_name(func):
+    return func.__module__ + "." + func.__qualname__
+
+
+def resolve_formula(name):
+    # formula_name 的反过来: "batch_IOL.SRK_T" -> 函数; 找不到(模块或函数已经删掉了)返回None
+    module, _, qualname = name.partition(".")
+    try:
+        obj = importlib.import_module(module)
+        for part in qualname.split("."):
+            obj = getattr(obj, part)
+    except (ImportError, AttributeError, ValueError):
+        return None
+    return obj
+
+
+_SOURCES = {}
+
+
+def _source_part(func):
+    if func not in _SOURCES:
+        deps = _formula_dependencies(func)
+        h = hashlib.sha256()
+        for name, f in sorted(deps.items()):
+            h.update(name.encode("utf-8"))
+            h.update(inspect.getsource(f).encode("utf-8"))
+        globals_of = {f.__module__: f.__globals__ for f in deps.values()}
+        _SOURCES[func] = (h.hexdigest(), [(globals_of[m], m, n) for m, n in _constant_names(deps)])
+    return _SOURCES[func]
+
+
+def formula_version(func):
+    source, constants = _source_part(func)
+    h = hashlib.sha256(source.encode("utf-8"))
+    for module_globals, module, name in constants:
+        h.update(("%s.%s=%s" % (module, name, _constant_text(module_globals.get(name)))).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def formula_versions(module=compute_IOL):
+    return {formula_name(f): formula_version(f)
+            for _, f in inspect.getmembers(module, inspect.isfunction)
+            if f.__module__ == module.__name__}
+
+
+# ## 输入参数规范化
+#
+# 位置参数和关键字参数都绑定到函数签名上, 补上默认值, 这样 `Haigis(R, AC, L, A, Rx)` 和
+# `Haigis(R, AC, L, A, Rx, a1=0.4)` 是同一个key. 数字一律转成float的repr, 23 和 23.0 也是同一个key.
+
+# In[ ]:
+
+
+def _canonical_value(v):
+    if v is None or isinstance(v, (bool, str)):
+        return v
+    if isinstance(v, np.ndarray):
+        a = np.ascontiguousarray(v, dtype=np.float64)
+        return {"shape": list(a.shape),
+                "sha256": hashlib.sha256((a + 0.0).tobytes()).hexdigest()}
+    if isinstance(v, (int, float, np.integer, np.floating)):
+        return repr(float(v) + 0.0)  # +0.0 把 -0.0 变成 0.0
+    raise TypeError("cannot canonicalize input of type %s" % type(v).__name__)
+
+
+def canonical_inputs(func, args, kwargs):
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+    return json.dumps({k: _canonical_value(v) for k, v in bound.arguments.items()},
+                      sort_keys=True, separators=(",", ":"))
+
+
+def cache_key(func, args, kwargs, version=None):
+    if version is None:
+        version = formula_version(func)
+    text = formula_name(func) + "|" + version + "|" + canonical_inputs(func, args, kwargs)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def array_digest(a):
+    a = np.ascontiguousarray(a)
+    return "%s%s:%s" % (a.dtype, a.shape, hashlib.sha256(a.tobytes()).hexdigest())
+
+
+def array_key(func, digests, version=None):
+    # 一整块数组输入(批量计算的一块)的key. digests: {列名: array_digest(列)}, 同一块里几个公式共用的列只算一次hash
+    if version is None:
+        version = formula_version(func)
+    inputs = json.dumps(digests, sort_keys=True, separators=(",", ":"))
+    text = formula_name(func) + "|" + version + "|" + inputs
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _dumps(value):
+    buf = io.BytesIO()
+    np.save(buf, np.asarray(value, dtype=np.float64), allow_pickle=False)
+    return buf.getvalue()
+
+
+def _loads(blob):
+    return np.load(io.BytesIO(blob), allow_pickle=False)[()]
+
+
+# ## 缓存本体
+#
+# 超过 `max_bytes` 或 `max_entries` 时, 按最近访问时间淘汰(LRU).
+
+# In[ ]:
+
+
+class ResultCache:
+    def __init__(self, path="IOL_cache.sqlite", max_bytes=256 * 2**20, max_entries=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS results (
+                               key TEXT PRIMARY KEY,
+                               formula TEXT NOT NULL,
+                               version TEXT NOT NULL,
+                               value BLOB NOT NULL,
+                               size INTEGER NOT NULL,
+                               last_access REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_lru ON results (last_access)")
+        self.db.commit()
+        # 条目数和总字节数记在内存里, 每次写入不用再扫一遍整张表
+        self._count, self._bytes = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size),0) FROM results").fetchone()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def version(self, func):
+        return formula_version(func)
+
+    def get(self, key):
+        row = self.db.execute("SELECT value FROM results WHERE key=?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE results SET last_access=? WHERE key=?", (time.time(), key))
+        return _loads(row[0])
+
+    def put(self, key, func, value, commit=True):
+        # commit=False 时不淘汰也不提交, 由调用者在一批写完以后调用 commit()
+        blob = _dumps(value)
+        old = self.db.execute("SELECT size FROM results WHERE key=?", (key,)).fetchone()
+        if old is not None:
+            self._count -= 1
+            self._bytes -= old[0]
+        self.db.execute("INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?)",
+                        (key, formula_name(func), self.version(func), blob, len(blob), time.time()))
+        self._count += 1
+        self._bytes += len(blob)
+        if commit:
+            self.commit()
+
+    def commit(self):
+        self.evict()
+        self.db.commit()
+
+    def call(self, func, *args, **kwargs):
+        key = cache_key(func, args, kwargs, self.version(func))
+        value = self.get(key)
+        if value is None:
+            value = func(*args, **kwargs)
+            self.put(key, func, value)
+        else:
+            self.db.commit()  # 提交 last_access 的更新
+        return value
+
+    def cached(self, func):
+        def wrapper(*args, **kwargs):
+            return self.call(func, *args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__wrapped__ = func
+        return wrapper
+
+    def map(self, func, rows):
+        # rows: 每个元素是一组位置参数(tuple)或关键字参数(dict). 只有没命中的才调用 func.
+        version = self.version(func)
+        results = []
+        for row in rows:
+            args, kwargs = ((), row) if isinstance(row, dict) else (tuple(row), {})
+            key = cache_key(func, args, kwargs, version)
+            value = self.get(key)
+            if value is None:
+                value = func(*args, **kwargs)
+                self.put(key, func, value, commit=False)
+            results.append(value)
+        self.commit()
+        return results
+
+    def evict(self):
+        extra_entries = 0 if self.max_entries is None else self._count - self.max_entries
+        extra_bytes = 0 if self.max_bytes is None else self._bytes - self.max_bytes
+        if extra_entries <= 0 and extra_bytes <= 0:
+            return 0
+        # 沿着 last_access 索引从最旧的开始数, 够了就停, 只读要删的那几行
+        k = freed = 0
+        for (size,) in self.db.execute("SELECT size FROM results ORDER BY last_access"):
+            if k >= extra_entries and freed >= extra_bytes:
+                break
+            k += 1
+            freed += size
+        self.db.execute("DELETE FROM results WHERE key IN "
+                        "(SELECT key FROM results ORDER BY last_access LIMIT ?)", (k,))
+        self._count -= k
+        self._bytes -= freed
+        self.evictions += k
+        return k
+
+    def _is_stale(self, formula, version):
+        # 每条结果和它自己所在模块里的当前函数比较; 函数已经不存在了也算过期
+        func = resolve_formula(formula)
+        return func is None or self.version(func) != version
+
+    def prune_stale(self):
+        # 删掉版本戳已经和当前代码对不上的结果
+        removed = 0
+        for formula, version in self.db.execute(
+                "SELECT DISTINCT formula, version FROM results").fetchall():
+            if self._is_stale(formula, version):
+                removed += self.db.execute("DELETE FROM results WHERE formula=? AND version=?",
+                                           (formula, version)).rowcount
+        self.db.commit()
+        self._count, self._bytes = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size),0) FROM results").fetchone()
+        return removed
+
+    def clear(self):
+        self.db.execute("DELETE FROM results")
+        self.db.commit()
+        self._count = self._bytes = 0
+
+    def stats(self):
+        entries, size = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size),0) FROM results").fetchone()
+        per_formula = {}
+        for formula, version, n, s in self.db.execute(
+                "SELECT formula, version, COUNT(*), SUM(size) FROM results GROUP BY formula, version"):
+            d = per_formula.setdefault(formula, {"entries": 0, "bytes": 0, "stale": 0})
+            d["entries"] += n
+            d["bytes"] += s
+            if self._is_stale(formula, version):
+                d["stale"] += n
+        lookups = self.hits + self.misses
+        return {"path": self.path,
+                "entries": entries,
+                "bytes": size,
+                "max_bytes": self.max_bytes,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "formulas": per_formula}
+
+    def report(self):
+        s = self.stats()
+        lines = ["cache: %s" % s["path"],
+                 "entries: %d, size: %.1f kB" % (s["entries"], s["bytes"] / 1024),
+                 "hits: %d, misses: %d, hit rate: %.1f%%, evictions: %d"
+                 % (s["hits"], s["misses"], 100 * s["hit_rate"], s["evictions"])]
+        for formula, d in sorted(s["formulas"].items()):
+            lines.append("  %-24s %8d entries %10.1f kB %8d stale"
+                         % (formula, d["entries"], d["bytes"] / 1024, d["stale"]))
+        return "\n".join(lines)
+
+
+# 逐行的 `call`/`map` 适合零散的标量计算; 一行一次SQLite查询, 比直接算一遍SRK/T还慢.
+# 整个病例库的批量计算按 "一块 × 一个公式" 缓存, 见 validate_IOL.checked_panel 和 batch_job.run 的 `cache` 参数:
+# 重新部署以后, 只有版本戳变了的公式会重算.
+#
+# 用法:
+# ```
+# with ResultCache("registry.sqlite") as cache:
+#     p = cache.call(compute_IOL.SRK_T, 23.5, 44, 118.4, -0.5)
+#     ps = cache.map(compute_IOL.HOFFER_Q, rows)
+#     print(cache.report())
+# ```
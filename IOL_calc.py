@@ -330,7 +330,7 @@ interact(Double_K_SRK_T_with_true_K_based_on_SIRC,
 
 
 def delta_IOL_power_masket(SIRC):
-    return SIRC*(-0.326+0.101)
+    return SIRC*(-0.326)+0.101
 def delta_IOL_power_latkany(RXpre, Ktype="avg"):
     if RXpre >0:
         delta_IOL= -1*(0.27 * RXpre + 1.53)
@@ -338,6 +338,8 @@ def delta_IOL_power_latkany(RXpre, Ktype="avg"):
         delta_IOL= -1*(0.46 * RXpre + 0.21)
     elif Ktype.lower()=="flattest":
         delta_IOL= -1*(0.47 * RXpre + 0.85)
+    else:
+        raise ValueError("unknown Ktype %r, expected 'avg' or 'flattest'" % Ktype)
     return delta_IOL
 
 
@@ -528,6 +530,17 @@ interact(BESST,
         );
 
 
+# # 综合计算面板
+# 
+# 上面每个公式都要单独填一遍数据. 下面这个面板所有公式共用一份病人数据, 拖动任意一个滑动条, 所有公式的结果和 "IOL度数-目标屈光度" 曲线一起更新. 详见 IOL_dashboard.py.
+
+# In[27]:
+
+
+from IOL_dashboard import Dashboard
+Dashboard().show()
+
+
 # In[ ]:
 
 
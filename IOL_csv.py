@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # CSV 批量导入/导出
+#
+# 与 IOL_excel.py 相同的表格形式: 第一行是列名(见 batch_IOL.PANEL), 以下每行一个病人.
+# CSV读写比Excel快得多, 大批量计算、断点续算、生物测量仪导出的文件都用这种格式.
+
+# In[ ]:
+
+
+import csv
+
+import numpy as np
+
+
+# ## 表格 → 列
+#
+# CSV 和 Excel (IOL_excel.py) 共用: 读出来的每一行是一个list/tuple, 格子可以是字符串(CSV),
+# 也可以是数字或者None(Excel).
+
+# In[ ]:
+
+
+def to_number(v):
+    if isinstance(v, bool):
+        return np.nan
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def columns_from_rows(header, rows, text_columns=()):
+    # 数字列转成float数组, 不是数字的格子为NaN; text_columns 里的列(比如晶体型号)保留为字符串
+    columns = {}
+    for j, name in enumerate(header):
+        if not name:
+            continue
+        if name in text_columns:
+            columns[name] = np.array([str(r[j]).strip() if j < len(r) and r[j] is not None else ""
+                                      for r in rows], dtype=object)
+        else:
+            columns[name] = np.array([to_number(r[j]) if j < len(r) else np.nan for r in rows])
+    return columns
+
+
+def concat_columns(parts):
+    # 逐块读出的 {列名: 数组} 接成一整张表
+    parts = list(parts)
+    if not parts:
+        return {}
+    return {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+
+
+# ## 读入
+#
+# 逐块读出 (表头, {列名: 数组}, 行号数组), 行号从2开始, 与在Excel里打开时看到的一致.
+# `skip_chunks` 用于断点续算: 前面已经算过的块只读过去, 不转换成数字.
+
+# In[ ]:
+
+
+def iter_chunks(path, chunk_rows=4096, skip_chunks=0, text_columns=()):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = [h.strip() for h in next(reader, [])]
+        buffer = []
+        numbers = []
+        chunk = 0
+        for number, row in enumerate(reader, start=2):
+            if not any(v.strip() for v in row):
+                continue
+            if chunk < skip_chunks:
+                buffer.append(None)
+            else:
+                buffer.append(row)
+                numbers.append(number)
+            if len(buffer) >= chunk_rows:
+                if chunk >= skip_chunks:
+                    yield header, columns_from_rows(header, buffer, text_columns), np.array(numbers)
+                chunk += 1
+                buffer = []
+                numbers = []
+        if buffer and chunk >= skip_chunks:
+            yield header, columns_from_rows(header, buffer, text_columns), np.array(numbers)
+
+
+def read_csv(path):
+    return concat_columns(columns for _, columns, _ in iter_chunks(path))
+
+
+def count_rows(path):
+    # 数换行符, 不解析内容. 空行也算进去, 只用来估计剩余时间.
+    n = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            n += block.count(b"\n")
+    return max(n - 1, 0)
+
+
+# ## 写出
+
+# In[ ]:
+
+
+def _text(v):
+    # NaN/inf 写成空格子
+    if isinstance(v, float) and not np.isfinite(v):
+        return ""
+    return v
+
+
+def write_csv(path, columns, mode="w"):
+    # columns: {列名: 数组}; mode="a" 时追加, 不再写表头
+    names = list(columns)
+    values = [np.asarray(columns[k]).tolist() for k in names]
+    with open(path, mode, newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        if mode == "w":
+            writer.writerow(names)
+        for row in zip(*values):
+            writer.writerow([_text(v) for v in row])
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # 综合计算面板
+#
+# IOL_calc.py 里每个 `interact(...)` 只控制一个公式, 想比较几个公式的结果, 就得在十几个输入框里反复填同样的数.
+# 这里做一个面板: 所有公式共用一份病人数据, 改一个滑动条,
+#
+# * 所有公式的结果, 和每个公式 "IOL度数-目标屈光度" 的曲线, 通过一次 batch_IOL 的数组计算全部得到
+# * 拖动滑动条时连续触发的事件会被节流(throttle): 第一个事件立即计算, 之后拖动过程中最多每 `delay` 秒
+#   计算一次, 松开以后再用最后的数值算一次, 所以拖动时曲线一直跟着变
+# * 只有数值变化了的输出才重新显示
+#
+# 在notebook里:
+# ```
+# from IOL_dashboard import Dashboard
+# Dashboard().show()
+# ```
+
+# In[ ]:
+
+
+import asyncio
+import time
+
+import numpy as np
+import ipywidgets as widgets
+
+import validate_IOL
+
+
+# ## 病人数据
+#
+# (列名, 说明, 默认值, 最小值, 最大值, 步长). 列名与 batch_IOL.PANEL 一致.
+# 同一个测量值只有一个滑动条: 现在测得的K在有的公式里叫 K, 有的叫 Kpost, 面板上只有 Kpost, K 跟着它变(SAME_AS).
+# 角膜半径 R 和前表面 rF 的默认值是同一个K换算成的半径 337.5/Kpost.
+
+# In[ ]:
+
+
+FIELDS = [
+    ("AL", "眼轴 mm", 23.5, 18.0, 34.0, 0.01),
+    ("Kpre", "术前K D", 44.0, 35.0, 55.0, 0.25),
+    ("Kpost", "K(术后) D", 42.0, 30.0, 55.0, 0.25),
+    ("Kflat", "最平坦K D", 41.5, 30.0, 55.0, 0.25),
+    ("SIRC", "SIRC D", -3.0, -12.0, 6.0, 0.25),
+    ("RXpre", "术前等效球镜 D", -3.0, -12.0, 6.0, 0.25),
+    ("ACD", "ACD mm", 3.5, 1.5, 5.0, 0.01),
+    ("A", "A常数", 118.4, 112.0, 122.0, 0.1),
+    ("Rx", "目标屈光度 D", -0.5, -5.0, 3.0, 0.25),
+    ("R", "角膜半径 mm", 8.04, 6.0, 10.0, 0.01),
+    ("rF", "前表面 mm", 8.04, 6.0, 10.0, 0.01),
+    ("rB", "后表面 mm", 6.8, 5.0, 9.0, 0.01),
+    ("CCT", "CCT μm", 540.0, 400.0, 700.0, 1.0),
+]
+
+SAME_AS = {"K": "Kpost"}
+
+RX_GRID = np.linspace(-3, 1, 33)
+
+
+def default_state():
+    return {name: value for name, _, value, _, _, _ in FIELDS}
+
+
+# ## 一次计算所有公式和曲线
+#
+# 第0行是当前的病人, 后面每一行是同一个病人换成 RX_GRID 中的目标屈光度. 整个面板只调用一次 checked_panel,
+# 不合理的输入(比如K=0)对应的结果是NaN, 不会报错.
+
+# In[ ]:
+
+
+def evaluate(state, rx_grid=RX_GRID):
+    n = 1 + len(rx_grid)
+    columns = {name: np.full(n, float(value)) for name, value in state.items()}
+    for name, source in SAME_AS.items():
+        columns[name] = columns[source]
+    columns["Rx"][1:] = rx_grid
+    results, _ = validate_IOL.checked_panel(columns)
+    panel = {name: float(v[0]) for name, v in results.items()}
+    curve = {name: v[1:] for name, v in results.items()}
+    return panel, curve
+
+
+# ## 曲线
+#
+# 不依赖matplotlib, 直接拼一段SVG, 几十个点画起来很快.
+
+# In[ ]:
+
+
+COLORS = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd",
+          "#8c564b", "#e377c2", "#7f7f7f", "#bcbd22", "#17becf",
+          "#393b79", "#637939", "#8c6d31", "#843c39"]
+
+
+def curve_svg(rx_grid, curve, width=420, height=260, pad=36):
+    finite = [v[np.isfinite(v)] for v in curve.values()]
+    finite = [v for v in finite if v.size]
+    if not finite:
+        return "<i>没有可以计算的公式</i>"
+    lo = min(v.min() for v in finite)
+    hi = max(v.max() for v in finite)
+    if hi - lo < 1e-9:
+        lo, hi = lo - 1, hi + 1
+    x0, x1 = float(rx_grid[0]), float(rx_grid[-1])
+
+    def xy(x, y):
+        return (pad + (x - x0) / (x1 - x0) * (width - 2 * pad),
+                height - pad - (y - lo) / (hi - lo) * (height - 2 * pad))
+
+    parts = ['<svg width="%d" height="%d" style="font: 10px sans-serif">' % (width, height),
+             '<rect x="%d" y="%d" width="%d" height="%d" fill="none" stroke="#ccc"/>'
+             % (pad, pad, width - 2 * pad, height - 2 * pad),
+             '<text x="%d" y="%d">%.1f</text>' % (2, pad + 4, hi),
+             '<text x="%d" y="%d">%.1f</text>' % (2, height - pad + 4, lo),
+             '<text x="%d" y="%d">%+.1f</text>' % (pad - 8, height - pad + 14, x0),
+             '<text x="%d" y="%d">%+.1f</text>' % (width - pad - 8, height - pad + 14, x1),
+             '<text x="%d" y="%d">目标屈光度 D</text>' % (width / 2 - 30, height - 6)]
+    for i, (name, values) in enumerate(curve.items()):
+        points = " ".join("%.1f,%.1f" % xy(x, y) for x, y in zip(rx_grid, values) if np.isfinite(y))
+        if points:
+            parts.append('<polyline points="%s" fill="none" stroke="%s" stroke-width="1.5">'
+                         '<title>%s</title></polyline>' % (points, COLORS[i % len(COLORS)], name))
+    parts.append("</svg>")
+    return "".join(parts)
+
+
+# ## 面板
+
+# In[ ]:
+
+
+class Dashboard:
+    def __init__(self, state=None, delay=0.05, rx_grid=RX_GRID):
+        self.state = default_state()
+        if state:
+            self.state.update(state)
+        self.delay = delay
+        self.rx_grid = rx_grid
+        self.last_ms = None
+        self._pending = None
+        self._last_refresh = -np.inf
+        self._shown = {}
+
+        self.inputs = {}
+        for name, description, _, lo, hi, step in FIELDS:
+            w = widgets.FloatSlider(value=self.state[name], min=lo, max=hi, step=step,
+                                    description=description, continuous_update=True,
+                                    style={"description_width": "90px"})
+            w.observe(self._on_change, names="value")
+            self.inputs[name] = w
+
+        self.outputs = {}
+        self.curve = widgets.HTML()
+        self.timing = widgets.Label()
+        self.results = widgets.VBox()
+        self.widget = widgets.HBox([widgets.VBox(list(self.inputs.values())),
+                                    widgets.VBox([self.results, self.curve, self.timing])])
+        self.refresh()
+
+    def show(self):
+        from IPython.display import display
+        display(self.widget)
+
+    def _on_change(self, change):
+        for name, w in self.inputs.items():
+            if w is change["owner"]:
+                self.state[name] = change["new"]
+        self._schedule()
+
+    def _schedule(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None or self.delay <= 0:
+            self.refresh()
+            return
+        if self._pending is not None:
+            return  # 已经排好的那次计算会用到最新的 state
+        wait = self._last_refresh + self.delay - time.monotonic()
+        if wait <= 0:
+            self.refresh()
+        else:
+            self._pending = loop.call_later(wait, self.refresh)
+
+    def _set(self, key, widget, value):
+        # 只有内容变了才更新, 避免不必要的前端重绘
+        if self._shown.get(key) != value:
+            self._shown[key] = value
+            widget.value = value
+
+    def refresh(self):
+        self._pending = None
+        self._last_refresh = time.monotonic()
+        t0 = time.perf_counter()
+        panel, curve = evaluate(self.state, self.rx_grid)
+        if list(self.outputs) != list(panel):
+            self.outputs = {name: widgets.HTML() for name in panel}
+            self.results.children = list(self.outputs.values())
+            self._shown = {}
+        for i, (name, value) in enumerate(panel.items()):
+            text = "%.2f D" % value if np.isfinite(value) else "—"
+            html = ('<span style="color:%s">■</span> <b>%s</b>: %s'
+                    % (COLORS[i % len(COLORS)], name, text))
+            self._set(name, self.outputs[name], html)
+        self._set("curve", self.curve, curve_svg(self.rx_grid, curve))
+        self.last_ms = (time.perf_counter() - t0) * 1000
+        self.timing.value = "%.1f ms" % self.last_ms
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Excel 批量导入/导出
+#
+# IOL_calc.xlsx 是一个病人一行, 手工填写, 一个单元格一个单元格地算. 病人多了以后很慢.
+# 这里换成表格的形式: 工作表第一行是列名(AL, K, Kpre, Kpost, ACD, A, Rx, R, rF, rB, CCT, a0, a1, a2,
+# 也接受 L, Kd, AC, REFt 这些 compute_IOL.py 里的写法, 见 batch_IOL.PANEL), 以下每行一个病人.
+#
+# * 用openpyxl的 read-only 模式逐行读入, 不把整个工作簿的单元格对象放进内存
+# * 每攒够 `chunk_rows` 行, 用 batch_IOL.formula_panel 一次算完所有公式
+# * 用 write-only 模式写出新的工作簿: 原来的工作表原样复制, 再加一个结果工作表
+#
+# 有哪些列就算哪些公式, 缺输入列的公式不出现在结果里. 每一块先经过 validate_IOL 校验,
+# 某一行缺数据或者超出生理范围, 这一行对应公式的结果是空的, 出错的列名写在 errors 列里.
+#
+# 项目自带的 IOL_calc.xlsx (一个公式一块) 也可以直接处理, 见下面的 iter_blocks.
+
+# In[ ]:
+
+
+import os
+import re
+import time
+
+import numpy as np
+from openpyxl import Workbook, load_workbook
+
+import batch_IOL
+import validate_IOL
+from IOL_csv import columns_from_rows, concat_columns, to_number
+
+
+def _cell(v):
+    # 结果写回Excel时, NaN/inf 写成空单元格
+    v = float(v)
+    return v if np.isfinite(v) else None
+
+
+# ## 读入
+
+# In[ ]:
+
+
+def iter_chunks(path, sheet=None, chunk_rows=4096, text_columns=(), skip_chunks=0):
+    # 逐块读出 (表头, {列名: 数组}, Excel行号数组). 与 IOL_csv.iter_chunks 一样, 前 skip_chunks 块只读过去, 不转换成数字
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet] if sheet else wb.worksheets[0]
+        rows = ws.iter_rows(values_only=True)
+        header = [str(h).strip() if h is not None else "" for h in next(rows, ())]
+        buffer = []
+        numbers = []
+        chunk = 0
+        for number, row in enumerate(rows, start=2):
+            if row is None or all(v is None for v in row):
+                continue
+            if chunk < skip_chunks:
+                buffer.append(None)
+            else:
+                buffer.append(row)
+                numbers.append(number)
+            if len(buffer) >= chunk_rows:
+                if chunk >= skip_chunks:
+                    yield header, columns_from_rows(header, buffer, text_columns), np.array(numbers)
+                chunk += 1
+                buffer = []
+                numbers = []
+        if buffer and chunk >= skip_chunks:
+            yield header, columns_from_rows(header, buffer, text_columns), np.array(numbers)
+    finally:
+        wb.close()
+
+
+def read_header(path, sheet=None):
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet] if sheet else wb.worksheets[0]
+        first = next(ws.iter_rows(values_only=True, max_row=1), ())
+    finally:
+        wb.close()
+    return [str(h).strip() if h is not None else "" for h in first]
+
+
+def read_workbook(path, sheet=None):
+    # 整个表读成 {列名: 数组}, 小表格或者交互使用时比较方便
+    return concat_columns(columns for _, columns, _ in iter_chunks(path, sheet))
+
+
+# ## 项目自带的 IOL_calc.xlsx
+#
+# IOL_calc.xlsx 不是上面的表格形式, 而是一个公式一块: 第一列是 `SRK_T(AL, Kd, A, REFt)` 这样的函数说明,
+# 后面是参数名; 下一行第一列是Excel公式, 后面是参数值. 参数的顺序与 compute_IOL.py 的函数签名相同,
+# 也就是 batch_IOL.PANEL 里的顺序, 所以按位置对应到列名.
+
+# In[ ]:
+
+
+BLOCK_LABEL = re.compile(r"^\s*(\w+)\s*\(")
+
+
+def iter_blocks(path, sheet=None):
+    # 逐块读出 (公式名, {列名: 长度为1的数组}, 参数值所在的Excel行号)
+    methods = {name.lower(): name for name in batch_IOL.PANEL}
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet] if sheet else wb.worksheets[0]
+        method = None
+        for number, row in enumerate(ws.iter_rows(values_only=True), start=1):
+            first = row[0] if row else None
+            match = BLOCK_LABEL.match(first) if isinstance(first, str) else None
+            if match and not first.startswith("="):
+                method = methods.get(match.group(1).lower())
+                continue
+            if method is None or all(v is None for v in row[1:]):
+                continue
+            _, args = batch_IOL.PANEL[method]
+            names = args + batch_IOL.OPTIONAL.get(method, ())
+            values = list(row[1:1 + len(names)])
+            columns = {a: np.array([to_number(v)]) for a, v in zip(names, values) if v is not None}
+            yield method, columns, number
+            method = None
+    finally:
+        wb.close()
+
+
+# ## 计算并写出
+#
+# openpyxl的 write-only 工作簿必须一行一行 append, 不能回头修改. 所以先把原来的工作表原样复制
+# (公式也原样保留), 然后把结果表逐块写出.
+
+# In[ ]:
+
+
+def _copy_sheets(path, out_wb):
+    src = load_workbook(path, read_only=True)
+    try:
+        for ws in src.worksheets:
+            dst = out_wb.create_sheet(ws.title)
+            for row in ws.iter_rows(values_only=True):
+                dst.append(row)
+    finally:
+        src.close()
+
+
+def process_workbook(path, out_path=None, sheet=None, methods=None,
+                     result_sheet="IOL_results", chunk_rows=4096, keep_inputs=True, cache=None):
+    if out_path is None:
+        root, ext = os.path.splitext(path)
+        out_path = root + "_results" + ext
+    if os.path.abspath(out_path) == os.path.abspath(path):
+        raise ValueError("out_path must differ from the input workbook")
+
+    t0 = time.perf_counter()
+    # 先确定表格的形式, 出错时还没有建立输出的工作簿
+    header = read_header(path, sheet)
+    names = methods if methods is not None else batch_IOL.available_methods({h: None for h in header if h})
+    if not names:
+        blocks = [b for b in iter_blocks(path, sheet) if methods is None or b[0] in methods]
+        if not blocks:
+            raise ValueError("no formula has all of its input columns in the first row of the sheet "
+                             "(got %s), and the sheet is not in the one-block-per-formula layout of "
+                             "IOL_calc.xlsx" % (", ".join(h for h in header if h) or "an empty row"))
+        return _process_blocks(path, out_path, blocks, result_sheet, keep_inputs, t0)
+
+    out = Workbook(write_only=True)
+    if keep_inputs:
+        _copy_sheets(path, out)
+    ws = out.create_sheet(result_sheet)
+    ws.append(["row"] + list(names) + ["errors"])
+
+    n_rows = 0
+    errors = {}
+    for header, columns, numbers in iter_chunks(path, sheet, chunk_rows):
+        results, codes = validate_IOL.checked_panel(columns, names, cache)
+        block = np.column_stack([results[m] for m in names])
+        for number, values, code in zip(numbers, block, codes):
+            ws.append([int(number)] + [_cell(v) for v in values]
+                      + [", ".join(validate_IOL.describe_errors(code)) or None])
+        for k, v in validate_IOL.summary(codes).items():
+            errors[k] = errors.get(k, 0) + v
+        n_rows += len(block)
+
+    out.save(out_path)
+    return {"out_path": out_path,
+            "rows": n_rows,
+            "methods": list(names),
+            "errors": errors,
+            "seconds": time.perf_counter() - t0}
+
+
+def _process_blocks(path, out_path, blocks, result_sheet, keep_inputs, t0):
+    # 一个公式一块的表格: 结果表每块一行 (参数所在的行号, 公式名, IOL度数, 错误)
+    out = Workbook(write_only=True)
+    if keep_inputs:
+        _copy_sheets(path, out)
+    ws = out.create_sheet(result_sheet)
+    ws.append(["row", "method", "IOL", "errors"])
+    errors = {}
+    for method, columns, number in blocks:
+        results, codes = validate_IOL.checked_panel(columns, [method])
+        ws.append([number, method, _cell(results[method][0]),
+                   ", ".join(validate_IOL.describe_errors(codes[0])) or None])
+        for k, v in validate_IOL.summary(codes).items():
+            errors[k] = errors.get(k, 0) + v
+    out.save(out_path)
+    return {"out_path": out_path,
+            "rows": len(blocks),
+            "methods": [method for method, _, _ in blocks],
+            "errors": errors,
+            "seconds": time.perf_counter() - t0}
+
+
+# 用法:
+# ```
+# summary = process_workbook("clinic.xlsx")
+# # -> clinic_results.xlsx, 多出一个 IOL_results 工作表, 第一列是对应的原始行号
+# ```
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # 监视生物测量仪导出目录
+#
+# 诊室里的生物测量仪一天到晚往共享文件夹里导出文件, 原来要有人把数值再抄到notebook里. 这里在本机上
+# 定时检查这个目录:
+#
+# * 新出现的、或者变大了的 CSV 文件, 只读取上次读到的位置之后新增的完整行; Excel文件变了就跳过已经处理过的行数
+# * 新的记录经过 validate_IOL.checked_panel 计算所有公式
+# * 如果记录里只有晶体型号(`lens` 列), 没有A常数, 从晶体常数表里查. 常数表只在文件改过以后才重新读, 平时都在内存里
+# * 结果追加到输出目录里按天滚动的 `IOL_results_YYYYMMDD.csv`
+#
+# 每个文件读到了哪里, 记在输出目录的 `watch_state.json` 里, 重启以后不会重复计算.
+# 读不了的文件(损坏的Excel等)不会让服务停下: 错误记在 `watch_state.json` 里, 这个文件再次改动以后才重试.
+# Excel打开文件时留下的 `~$` 锁文件和隐藏的临时文件不处理.
+# 不依赖额外的库, 空闲时每隔 `interval` 秒只列一次目录, 几乎不占CPU.
+#
+# ```
+# Watcher("//server/biometer_exports", "results", lens_constants="lens_constants.csv").run()
+# ```
+
+# In[ ]:
+
+
+import csv
+import io
+import json
+import os
+import time
+
+import numpy as np
+
+import IOL_csv
+import batch_IOL
+import validate_IOL
+from batch_job import atomic_write
+
+
+STATE = "watch_state.json"
+IGNORE_PREFIXES = ("~$", ".", "~")
+LENS_COLUMNS = ("A", "a0", "a1", "a2")
+
+
+# ## 晶体常数表
+#
+# CSV, 第一列 `lens` 是晶体型号, 其他列是 A, a0, a1, a2 (可以缺). 型号不区分大小写.
+
+# In[ ]:
+
+
+class LensConstants:
+    def __init__(self, path=None):
+        self.path = path
+        self.table = {}
+        self._mtime_ns = None
+
+    def refresh(self):
+        if self.path is None:
+            return self.table
+        mtime_ns = os.stat(self.path).st_mtime_ns
+        if mtime_ns != self._mtime_ns:
+            table = {}
+            with open(self.path, newline="", encoding="utf-8-sig") as f:
+                for row in csv.DictReader(f):
+                    name = (row.pop("lens", "") or "").strip().lower()
+                    if name:
+                        table[name] = {k: IOL_csv.to_number(v) for k, v in row.items() if k in LENS_COLUMNS}
+            self.table = table
+            self._mtime_ns = mtime_ns
+        return self.table
+
+    def fill(self, columns):
+        # 有 lens 列时, 把 A/a0/a1/a2 中空着的格子用常数表补上
+        if "lens" not in columns:
+            return columns
+        table = self.refresh()
+        names, inverse = np.unique(np.char.lower(columns["lens"].astype(str)), return_inverse=True)
+        for key in LENS_COLUMNS:
+            values = np.array([table.get(name, {}).get(key, np.nan) for name in names])[inverse]
+            if key in columns:
+                current = columns[key]
+                columns[key] = np.where(np.isnan(current), values, current)
+            elif not np.all(np.isnan(values)):
+                columns[key] = values
+        return columns
+
+
+# ## 读取新增的记录
+
+# In[ ]:
+
+
+def _read_new_csv(path, entry):
+    # 从上次的位置读到最后一个完整的行
+    with open(path, "rb") as f:
+        f.seek(entry["offset"])
+        data = f.read()
+    cut = data.rfind(b"\n")
+    if cut < 0:
+        return None
+    data = data[:cut + 1]
+    text = data.decode("utf-8-sig" if entry["offset"] == 0 else "utf-8")
+    rows = list(csv.reader(io.StringIO(text)))
+    if entry["offset"] == 0:
+        entry["header"] = [h.strip() for h in rows.pop(0)] if rows else []
+    entry["offset"] += len(data)
+    numbers = []
+    kept = []
+    for row in rows:
+        entry["lines"] += 1
+        if any(v.strip() for v in row):
+            kept.append(row)
+            numbers.append(entry["lines"] + 1)
+    if not kept:
+        return None
+    columns = IOL_csv.columns_from_rows(entry["header"], kept, text_columns=("lens",))
+    return columns, np.array(numbers)
+
+
+def _read_new_excel(path, entry):
+    import IOL_excel
+    parts = []
+    for _, columns, numbers in IOL_excel.iter_chunks(path, text_columns=("lens",)):
+        keep = numbers > entry["last_row"]
+        if keep.any():
+            parts.append(({k: v[keep] for k, v in columns.items()}, numbers[keep]))
+    if not parts:
+        return None
+    columns = IOL_csv.concat_columns(p[0] for p in parts)
+    numbers = np.concatenate([p[1] for p in parts])
+    entry["last_row"] = int(numbers[-1])
+    return columns, numbers
+
+
+# ## 监视
+
+# In[ ]:
+
+
+class Watcher:
+    def __init__(self, watch_dir, out_dir, lens_constants=None, interval=0.5, settle=0.2,
+                 patterns=(".csv", ".xlsx")):
+        if os.path.abspath(watch_dir) == os.path.abspath(out_dir):
+            raise ValueError("out_dir must differ from watch_dir, or the results would be read back in")
+        self.watch_dir = watch_dir
+        self.out_dir = out_dir
+        self.lens = LensConstants(lens_constants)
+        self.interval = interval
+        self.settle = settle
+        self.patterns = patterns
+        self.methods = list(batch_IOL.PANEL)
+        os.makedirs(out_dir, exist_ok=True)
+        self.state = self._load_state()
+        self.stats = {"files": 0, "rows": 0, "errors": 0, "last_latency": None}
+
+    def _load_state(self):
+        path = os.path.join(self.out_dir, STATE)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        return {}
+
+    def _save_state(self):
+        data = json.dumps(self.state, indent=1).encode("utf-8")
+        atomic_write(os.path.join(self.out_dir, STATE), lambda f: f.write(data))
+
+    def _changed_files(self):
+        now = time.time()
+        changed = []
+        with os.scandir(self.watch_dir) as it:
+            for e in it:
+                if not e.is_file() or not e.name.lower().endswith(self.patterns):
+                    continue
+                if e.name.startswith(IGNORE_PREFIXES):
+                    continue
+                st = e.stat()
+                entry = self.state.get(e.name)
+                if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+                    continue
+                # Excel文件要整个写完才能读, 等它一段时间不再变化
+                if e.name.lower().endswith(".xlsx") and now - st.st_mtime < self.settle:
+                    continue
+                changed.append((e.name, st))
+        return sorted(changed, key=lambda x: x[1].st_mtime_ns)
+
+    def _results_path(self):
+        return os.path.join(self.out_dir, time.strftime("IOL_results_%Y%m%d.csv"))
+
+    def process_file(self, name, st):
+        t0 = time.perf_counter()
+        path = os.path.join(self.watch_dir, name)
+        # 在副本上修改, 出错时原来记录的位置不变
+        entry = dict(self.state.get(name) or {})
+        entry.pop("error", None)
+        if "offset" not in entry or st.st_size < entry["size"]:
+            # 新文件, 或者文件被重写了(变小了), 从头开始
+            entry = {"offset": 0, "lines": 0, "last_row": 1, "header": []}
+        if name.lower().endswith(".xlsx"):
+            new = _read_new_excel(path, entry)
+        else:
+            new = _read_new_csv(path, entry)
+        entry["size"] = st.st_size
+        entry["mtime_ns"] = st.st_mtime_ns
+
+        rows = 0
+        if new is not None:
+            columns, numbers = new
+            columns = self.lens.fill(batch_IOL.canonical_columns(columns))
+            columns.pop("lens", None)
+            results, codes = validate_IOL.checked_panel(columns)
+            rows = len(numbers)
+            out = {"file": np.array([name] * rows, dtype=object), "row": numbers,
+                   "errors": np.array([", ".join(validate_IOL.describe_errors(c)) for c in codes],
+                                      dtype=object)}
+            for m in self.methods:
+                out[m] = results.get(m, np.full(rows, np.nan))
+            path_out = self._results_path()
+            IOL_csv.write_csv(path_out, out, "a" if os.path.exists(path_out) else "w")
+
+        self.state[name] = entry
+        self._save_state()
+        latency = time.perf_counter() - t0
+        self.stats["files"] += 1
+        self.stats["rows"] += rows
+        self.stats["last_latency"] = latency
+        return {"file": name, "rows": rows, "seconds": latency}
+
+    def _record_error(self, name, st, error):
+        # 记下出错时文件的大小和修改时间, 文件没再变过就不重试
+        entry = dict(self.state.get(name) or {})
+        entry.update(size=st.st_size, mtime_ns=st.st_mtime_ns,
+                     error="%s: %s" % (type(error).__name__, error))
+        self.state[name] = entry
+        self._save_state()
+        self.stats["errors"] += 1
+        return {"file": name, "rows": 0, "error": entry["error"]}
+
+    def poll(self):
+        results = []
+        for name, st in self._changed_files():
+            try:
+                results.append(self.process_file(name, st))
+            except Exception as error:
+                results.append(self._record_error(name, st, error))
+        return results
+
+    def run(self, max_polls=None, on_result=None):
+        polls = 0
+        while max_polls is None or polls < max_polls:
+            for r in self.poll():
+                if on_result is not None:
+                    on_result(r)
+            polls += 1
+            if max_polls is None or polls < max_polls:
+                time.sleep(self.interval)
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # IOL 批量计算
+#
+# compute_IOL.py 里的公式是一个病人一个病人算的, 里面有 `if AL<=24.2` 这样的分支, 只能输入标量.
+# 这里把同样的公式改写成numpy数组的形式: 分支换成 `np.where`, 一次调用就能算完一整列病人.
+# 对每个病人的计算结果与 compute_IOL.py 中的标量版本一致.
+
+# In[ ]:
+
+
+from contextlib import contextmanager
+
+import numpy as np
+
+
+# ## 计算精度
+#
+# 眼轴、K值、前房深度这些数据只有三四位有效数字, 用float64存储是浪费. 大批量计算(蒙特卡洛、整个病例库)时,
+# 可以切换到float32: 输入和中间数组都是float32, 内存带宽减半; 只有最后 1336/(S1*S2) 这类
+# 相减再相除的项转成float64计算, 结果再存回float32. `check_precision` 验证与float64的差别在0.01D以内.
+#
+# BESSt 的分支(k_conv 在 37.5/41.44/45 D 处换折射率, 眼轴<=22mm 或 Rc<=0 时换成Hoffer Q)是跳变的, 两边差1D以上,
+# float32 的舍入会让阈值附近的点选错分支. 所以这些分支条件总是用float64判断. 输入要以float64给出
+# (公式里面再转成float32): 输入本身已经存成float32的话, 离阈值不到float32舍入误差(相对约1e-7)的值
+# 已经被舍入到阈值的另一边了, 这不在0.01D的保证之内.
+
+# In[ ]:
+
+
+PRECISIONS = {"float64": np.float64, "float32": np.float32}
+_dtype = np.float64
+
+
+def set_precision(name):
+    global _dtype
+    previous = np.dtype(_dtype).name
+    _dtype = PRECISIONS[name]
+    return previous
+
+
+@contextmanager
+def precision(name):
+    previous = set_precision(name)
+    try:
+        yield
+    finally:
+        set_precision(previous)
+
+
+def _f(x):
+    return np.asarray(x, dtype=_dtype)
+
+
+def _acc(*xs):
+    # 需要float64累加的项
+    return tuple(np.asarray(x, dtype=np.float64) for x in xs)
+
+
+def _out(x):
+    return np.asarray(x, dtype=_dtype)
+
+
+def tan(x):
+    return np.tan(np.radians(x))
+
+
+# ## SRK/T 和 Double-K SRK/T
+
+# In[ ]:
+
+
+def SRK_T_Rc(AL, Kd, A, REFt):
+    AL = _f(AL); Kd = _f(Kd)
+    Lc = np.where(AL <= 24.2, AL, -3.446 + 1.716 * AL - 0.0237 * AL**2)
+    Rmm = 337.5 / Kd
+    C1 = -5.40948 + 0.58412 * Lc + 0.098 * Kd
+    return Rmm**2 - (C1**2) / 4
+
+
+def SRK_T(AL, Kd, A, REFt):
+    AL = _f(AL); Kd = _f(Kd); A = _f(A); REFt = _f(REFt)
+    Rethick = 0.65696 - 0.02029 * AL
+    Lc = np.where(AL <= 24.2, AL, -3.446 + 1.716 * AL - 0.0237 * AL**2)
+    Rmm = 337.5 / Kd
+    C1 = -5.40948 + 0.58412 * Lc + 0.098 * Kd
+    Rc = np.maximum(Rmm**2 - (C1**2) / 4, 0)
+    C2 = Rmm - np.sqrt(Rc)
+    ACD = 0.62467 * A - 68.74709
+    ACDE = C2 + ACD - 3.3357
+    n1 = 1.336
+    n2 = 0.333
+    L0 = AL + Rethick
+    S1 = L0 - ACDE
+    S2 = n1 * Rmm - n2 * ACDE
+    S3 = n1 * Rmm - n2 * L0
+    S4 = 12 * S3 + L0 * Rmm
+    S5 = 12 * S2 + ACDE * Rmm
+    S1, S2, S3, S4, S5, REFt = _acc(S1, S2, S3, S4, S5, REFt)
+    return _out((1336 * (S3 - 0.001 * REFt * S4)) / (S1 * (S2 - 0.001 * REFt * S5)))
+
+
+def Double_K_SRK_T(AL, Kpre, Kpost, A, REFt):
+    AL = _f(AL); Kpre = _f(Kpre); Kpost = _f(Kpost); A = _f(A); REFt = _f(REFt)
+    Lcor = np.where(AL <= 24.2, AL, -3.446 + 1.716 * AL - 0.0237 * AL**2)
+    Rpre = 337.5 / Kpre
+    Rpost = 337.5 / Kpost
+    CW = -5.40948 + 0.58412 * Lcor + 0.098 * Kpre
+    Rc = np.maximum(Rpre**2 - CW**2 / 4, 0)
+    H = Rpre - np.sqrt(Rc)
+    ACDconst = 0.62467 * A - 68.74709
+    Offset = ACDconst - 3.3357
+    ACDest = H + Offset
+    na = 1.336; V = 12; nc = 1.333; C2 = nc - 1
+    Rethick = 0.65696 - 0.02029 * AL
+    L0PT = AL + Rethick
+    S1 = L0PT - ACDest
+    S2 = na * Rpost - C2 * ACDest
+    S3 = na * Rpost - C2 * L0PT
+    S4 = V * S3 + L0PT * Rpost
+    S5 = V * S2 + ACDest * Rpost
+    S1, S2, S3, S4, S5, REFt = _acc(S1, S2, S3, S4, S5, REFt)
+    return _out((1336 * (S3 - 0.001 * REFt * S4)) / (S1 * (S2 - 0.001 * REFt * S5)))
+
+
+# ## Hoffer Q
+
+# In[ ]:
+
+
+def HOFFER_Q(AL, K, ACD, Rx):
+    AL = _f(AL); K = _f(K); ACD = _f(ACD); Rx = _f(Rx)
+    # M, G 按照截断之前的眼轴来取
+    M = _f(np.where(AL <= 23, 1.0, -1.0))
+    G = _f(np.where(AL <= 23, 28.0, 23.5))
+    AL = np.clip(AL, 18.5, 31)
+    CD = ACD + 0.3 * (AL - 23.5)
+    CD = CD + tan(K)**2
+    CD = CD + 0.1 * M * (23.5 - AL)**2 * tan(0.1 * (G - AL)**2) - 0.99166
+    R = Rx / (1 - 0.012 * Rx)
+    AL, K, CD, R = _acc(AL, K, CD, R)
+    return _out((1336 / (AL - CD - 0.05)) - (1.336 / ((1.336 / (K + R)) - ((CD + 0.05) / 1000))))
+
+
+# ## Shammas, Haigis, Haigis-L
+
+# In[ ]:
+
+
+def shammas(Kpost, L, A, R):
+    Kpost = _f(Kpost); L = _f(L); A = _f(A); R = _f(R)
+    KS = 1.14 * Kpost - 6.8
+    C = 0.5835 * A - 64.40
+    K = KS
+    L, K, C, R = _acc(L, K, C, R)
+    return _out(1336 / (L - 0.1 * (L - 23) - C - 0.05) - 1 / (1.0125 / (K + R) - (C + 0.05) / 1336))
+
+
+def Haigis(R, AC, L, A, Rx, a0=None, a1=0.400, a2=0.100):
+    R = _f(R); AC = _f(AC); L = _f(L); A = _f(A); Rx = _f(Rx)
+    a1 = _f(a1); a2 = _f(a2)
+    # a0 没有给出(或者表格里是空的)时, 由A常数换算
+    a0_default = 0.62467 * A - 72.434
+    a0 = a0_default if a0 is None else np.where(np.isnan(_f(a0)), a0_default, _f(a0))
+    u = -0.241
+    v = 0.139
+    d = np.where(AC == 0,
+                 (a0 + u * a1) + (a2 + v * a1) * L,
+                 a0 + a1 * AC + a2 * L)
+    n = 1.336; Nc = 1.3315
+    Dx = 12 / 1000
+    R = R / 1000
+    L = L / 1000
+    d = d / 1000
+    Dc = (Nc - 1) / R
+    z = Dc + Rx / (1 - Rx * Dx)
+    L, d, z = _acc(L, d, z)
+    return _out(n / (L - d) - n / (n / z - d))
+
+
+def Haigis_L(R, AC, L, A, Rx, a0=None, a1=0.400, a2=0.100):
+    R_corr = 331.5 / (-5.1625 * _f(R) + 82.2603 - 0.35)
+    return Haigis(R_corr, AC, L, A, Rx, a0, a1, a2)
+
+
+# ## BESSt
+#
+# 眼轴<=22.0mm, 或者SRK/T里被开方的数<=0时, 用Hoffer Q; 其他用SRK/T. 两个都算出来, 再按条件挑.
+
+# In[ ]:
+
+
+def BESSt_K(rF, rB, CCT):
+    k_conv = 337.5 / np.asarray(rF, dtype=np.float64)
+    rF = _f(rF); rB = _f(rB); CCT = _f(CCT)
+    n_air = 1
+    n_vc = 1.3265
+    n_CCT = n_vc + (CCT * 0.000022)
+    n_adj = np.select([k_conv < 37.5, k_conv < 41.44, k_conv < 45],
+                      [n_CCT + 0.017, n_CCT, n_CCT - 0.015],
+                      n_CCT)
+    n_acq = 1.336
+    d = (CCT / 1000000) / n_vc
+    return ((1 / rF * (n_adj - n_air))
+            + (1 / rB * (n_acq - n_adj))
+            - (d * 1 / rF * (n_adj - n_air)
+               * 1 / rB * (n_acq - n_adj))) * 1000
+
+
+def BESST(rF, rB, CCT, AL, ACD, A, Rx):
+    # 选分支用float64 (见"计算精度"), K 算好以后再转成当前精度
+    with precision("float64"):
+        K = BESSt_K(rF, rB, CCT)
+        use_hoffer = (_f(AL) <= 22.0) | (SRK_T_Rc(AL, K, A, Rx) <= 0)
+    AL = _f(AL)
+    K = _f(K)
+    return np.where(use_hoffer, HOFFER_Q(AL, K, ACD, Rx), SRK_T(AL, K, A, Rx))
+
+
+# ## 病史数据已知时的K值修正
+#
+# 与 IOL_calc.py 中的同名函数相同, 修正以后的K值代入 Double-K SRK/T. 列名约定: Kpre 是角膜屈光手术前的SimK,
+# Kpost 是现在测量的SimK, SIRC 是屈光手术引起的屈光度变化.
+
+# In[ ]:
+
+
+N_POST = {"savini": (1.338, 0.0009856),
+          "camellin": (1.3319, 0.00113),
+          "jarade": (1.3375, 0.0014),
+          }
+
+
+def true_K(preopSimK, postopSimK):
+    preopSimK = _f(preopSimK); postopSimK = _f(postopSimK)
+    return postopSimK * 0.376 / 0.3375 + (preopSimK - preopSimK * 0.376 / 0.3375)
+
+
+def true_K_based_on_SIRC(SimK, SIRC, method="savini"):
+    n0, n1 = N_POST[method.lower()]
+    n_2 = n0 + n1 * _f(SIRC)
+    r = (1.3375 - 1) / _f(SimK)
+    return (n_2 - 1) / r
+
+
+def Double_K_true_K(AL, Kpre, Kpost, A, REFt):
+    return Double_K_SRK_T(AL, Kpre, true_K(Kpre, Kpost), A, REFt)
+
+
+def Double_K_SIRC(AL, Kpre, Kpost, A, REFt, SIRC, method="savini"):
+    return Double_K_SRK_T(AL, Kpre, true_K_based_on_SIRC(Kpost, SIRC, method), A, REFt)
+
+
+def Double_K_CHM(AL, Kpre, SIRC, A, REFt):
+    return Double_K_SRK_T(AL, Kpre, _f(Kpre) - _f(SIRC), A, REFt)
+
+
+# ## 直接修正IOL计算结果
+#
+# Masket 和 Latkany 的方法: 先用 single-K 的公式算出IOL度数, 近视手术史用 SRK/T, 远视手术史用 Hoffer Q,
+# 再加上一个修正量. 这里按行用掩码选择公式, 一整批病人一次算完.
+#
+# * Masket: $\Delta IOL = SIRC \times (-0.326) + 0.101$, SIRC 近视为负, SIRC>0 的按远视手术史处理
+# * Latkany: 按屈光手术前的等效球镜 RXpre 计算, RXpre>0 为远视. 近视有两种, 代入 SRK/T 的是K1,K2的平均值(avg),
+#   还是最平坦的K(flattest); flattest 的基础公式也用最平坦的K (列名 Kflat) 计算.
+
+# In[ ]:
+
+
+def delta_IOL_power_masket(SIRC):
+    return _f(SIRC) * (-0.326) + 0.101
+
+
+LATKANY = {"avg": (0.46, 0.21), "flattest": (0.47, 0.85)}
+
+
+def delta_IOL_power_latkany(RXpre, Ktype="avg"):
+    if Ktype.lower() not in LATKANY:
+        raise ValueError("unknown Ktype %r, expected 'avg' or 'flattest'" % Ktype)
+    a, b = LATKANY[Ktype.lower()]
+    RXpre = _f(RXpre)
+    return np.where(RXpre > 0, -1 * (0.27 * RXpre + 1.53), -1 * (a * RXpre + b))
+
+
+def single_K_base(AL, K, ACD, A, Rx, hyperopic):
+    # 近视手术史 SRK/T, 远视手术史 Hoffer Q
+    return np.where(hyperopic, HOFFER_Q(AL, K, ACD, Rx), SRK_T(AL, K, A, Rx))
+
+
+def Masket(AL, K, ACD, A, Rx, SIRC):
+    SIRC = _f(SIRC)
+    return single_K_base(AL, K, ACD, A, Rx, SIRC > 0) + delta_IOL_power_masket(SIRC)
+
+
+def Latkany(AL, K, ACD, A, Rx, RXpre):
+    RXpre = _f(RXpre)
+    return single_K_base(AL, K, ACD, A, Rx, RXpre > 0) + delta_IOL_power_latkany(RXpre, "avg")
+
+
+def Latkany_flattest(AL, Kflat, ACD, A, Rx, RXpre):
+    RXpre = _f(RXpre)
+    return single_K_base(AL, Kflat, ACD, A, Rx, RXpre > 0) + delta_IOL_power_latkany(RXpre, "flattest")
+
+
+# ## 公式面板
+#
+# 各个公式的参数名字不统一(AL/L, REFt/Rx/R, Kd/K...), 这里统一成病人数据的列名:
+#
+# | 列名 | 含义 |
+# | --- | --- |
+# | AL | 眼轴长度 mm |
+# | K | 角膜曲率 D (single-K) |
+# | Kpre, Kpost | 角膜屈光手术前后的角膜曲率 D |
+# | ACD | 前房深度 mm |
+# | A | A常数 |
+# | Rx | 目标屈光度 D |
+# | R | 角膜曲率半径 mm (Haigis) |
+# | rF, rB, CCT | 角膜前后表面曲率半径 mm, 中央角膜厚度 μm (BESSt) |
+# | a0, a1, a2 | Haigis常数(可选) |
+# | SIRC | 角膜屈光手术引起的屈光度变化 D |
+# | RXpre | 角膜屈光手术前的等效球镜 D |
+# | Kflat | 最平坦的K D |
+#
+# `PANEL` 中每个公式对应的列名按照函数参数的顺序排列, 可选参数放在 `OPTIONAL` 里.
+# Masket, Latkany 只在远视手术史(SIRC 或 RXpre > 0)的行上用 Hoffer Q, 只有这些行需要 ACD; 近视的行用 SRK/T,
+# ACD 可以没有. `HYPEROPIC_ONLY` 里记下 (这样的列, 判断远视的列).
+
+# In[ ]:
+
+
+PANEL = {
+    "Double_K_SRK_T": (Double_K_SRK_T, ("AL", "Kpre", "Kpost", "A", "Rx")),
+    "SRK_T": (SRK_T, ("AL", "K", "A", "Rx")),
+    "Hoffer_Q": (HOFFER_Q, ("AL", "K", "ACD", "Rx")),
+    "Haigis": (Haigis, ("R", "ACD", "AL", "A", "Rx")),
+    "Haigis_L": (Haigis_L, ("R", "ACD", "AL", "A", "Rx")),
+    "Shammas": (shammas, ("Kpost", "AL", "A", "Rx")),
+    "BESST": (BESST, ("rF", "rB", "CCT", "AL", "ACD", "A", "Rx")),
+    "Double_K_true_K": (Double_K_true_K, ("AL", "Kpre", "Kpost", "A", "Rx")),
+    "Double_K_SIRC": (Double_K_SIRC, ("AL", "Kpre", "Kpost", "A", "Rx", "SIRC")),
+    "Double_K_CHM": (Double_K_CHM, ("AL", "Kpre", "SIRC", "A", "Rx")),
+    "Masket": (Masket, ("AL", "K", "ACD", "A", "Rx", "SIRC")),
+    "Latkany": (Latkany, ("AL", "K", "ACD", "A", "Rx", "RXpre")),
+    "Latkany_flattest": (Latkany_flattest, ("AL", "Kflat", "ACD", "A", "Rx", "RXpre")),
+}
+
+OPTIONAL = {
+    "Haigis": ("a0", "a1", "a2"),
+    "Haigis_L": ("a0", "a1", "a2"),
+}
+
+HYPEROPIC_ONLY = {
+    "Masket": ("ACD", "SIRC"),
+    "Latkany": ("ACD", "RXpre"),
+    "Latkany_flattest": ("ACD", "RXpre"),
+}
+
+# compute_IOL.py 和 IOL_calc.xlsx 里用到的其他写法
+ALIASES = {"L": "AL", "Kd": "K", "AC": "ACD", "REFt": "Rx"}
+
+
+def canonical_columns(columns):
+    return {ALIASES.get(k, k): v for k, v in columns.items()}
+
+
+def required_columns(name):
+    # 每一行都需要的列
+    _, args = PANEL[name]
+    partial = HYPEROPIC_ONLY.get(name, (None,))[0]
+    return tuple(a for a in args if a != partial)
+
+
+def available_methods(columns):
+    columns = canonical_columns(columns)
+    return [name for name in PANEL if all(a in columns for a in required_columns(name))]
+
+
+def formula_panel(columns, methods=None):
+    # columns: {列名: 数组}, 返回 {公式名: 数组}; 缺少输入列的公式跳过
+    columns = canonical_columns(columns)
+    if methods is None:
+        methods = available_methods(columns)
+    results = {}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for name in methods:
+            func, args = PANEL[name]
+            kwargs = {}
+            for i, a in enumerate(OPTIONAL.get(name, ())):
+                if a in columns:
+                    values = _f(columns[a])
+                    if a != "a0":
+                        # a1, a2 空着的用默认值
+                        default = func.__defaults__[i]
+                        values = np.where(np.isnan(values), default, values)
+                    kwargs[a] = values
+            # 没有给出的 HYPEROPIC_ONLY 列是NaN, 只影响远视的行
+            results[name] = func(*(columns.get(a, np.nan) for a in args), **kwargs)
+    return results
+
+
+# ## 精度验证
+#
+# 在生理范围内随机取点(再加上每个范围的两端), 分别用float32和float64计算整个公式面板, 比较最大误差.
+# 随机取点几乎碰不到分支的阈值, 所以再加上 BESSt 每个阈值两边的点(STEPS), 和 SRK/T 被开方的数 Rc=0 两边的点.
+
+# In[ ]:
+
+
+PHYSIOLOGICAL = {
+    "AL": (20.0, 32.0),
+    "K": (35.0, 50.0),
+    "Kpre": (38.0, 50.0),
+    "Kpost": (33.0, 48.0),
+    "ACD": (2.0, 4.5),
+    "A": (115.0, 121.0),
+    "Rx": (-3.0, 1.0),
+    "R": (6.75, 9.6),
+    "rF": (6.75, 9.6),
+    "rB": (5.5, 8.5),
+    "CCT": (450.0, 650.0),
+    "SIRC": (-10.0, 4.0),
+    "RXpre": (-10.0, 5.0),
+    "Kflat": (33.0, 48.0),
+}
+
+
+def random_columns(n, seed=0, ranges=PHYSIOLOGICAL):
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for name, (lo, hi) in ranges.items():
+        values = rng.uniform(lo, hi, n)
+        values[:2] = lo, hi
+        columns[name] = values
+    return columns
+
+
+# 有跳变的分支条件 (列名, 阈值), 和放在阈值两边的相对偏移
+STEPS = [("rF", 337.5 / 37.5), ("rF", 337.5 / 41.44), ("rF", 337.5 / 45), ("AL", 22.0)]
+STEP_OFFSETS = (1e-8, 1e-7, 1e-6, 1e-4)
+
+
+def _rc_root(columns, ranges=PHYSIOLOGICAL):
+    # BESSt: 对每一行二分找出 Rc=0 的眼轴(Rc随眼轴单调减小); 范围内没有根的行去掉
+    with precision("float64"):
+        K = BESSt_K(columns["rF"], columns["rB"], columns["CCT"])
+        lo = np.full(K.shape, ranges["AL"][0])
+        hi = np.full(K.shape, ranges["AL"][1])
+        keep = (SRK_T_Rc(lo, K, columns["A"], columns["Rx"]) > 0) & (SRK_T_Rc(hi, K, columns["A"], columns["Rx"]) <= 0)
+        for _ in range(60):
+            mid = (lo + hi) / 2
+            above = SRK_T_Rc(mid, K, columns["A"], columns["Rx"]) > 0
+            lo = np.where(above, mid, lo)
+            hi = np.where(above, hi, mid)
+    return {k: v[keep] for k, v in dict(columns, AL=lo).items()}
+
+
+def step_columns(n, seed=0):
+    # 随机的行, 只把一列放到阈值两边
+    offsets = np.concatenate([-np.array(STEP_OFFSETS), STEP_OFFSETS])
+    parts = []
+    for i, (name, threshold) in enumerate(STEPS):
+        columns = random_columns(n, seed + 1 + i)
+        columns[name] = threshold * (1 + np.resize(offsets, n))
+        parts.append(columns)
+    columns = _rc_root(random_columns(n, seed + 1 + len(STEPS)))
+    columns["AL"] = columns["AL"] * (1 + np.resize(offsets, len(columns["AL"])))
+    parts.append(columns)
+    return {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+
+
+def check_precision(n=1000000, seed=0, tolerance=0.01, n_steps=10000):
+    # 输入都以float64给出, 公式在float32精度下自己转换(见"计算精度")
+    columns = random_columns(n, seed)
+    steps = step_columns(n_steps, seed)
+    columns = {k: np.concatenate([v, steps[k]]) for k, v in columns.items()}
+    n = len(columns["AL"])
+    reference = formula_panel(columns)
+    with precision("float32"):
+        low = formula_panel(columns)
+    errors = {name: float(np.max(np.abs(low[name].astype(np.float64) - reference[name])))
+              for name in reference}
+    # PANEL 里加了新公式而上面没有给出它的输入范围时, 这个公式不会被检查, 要报出来
+    unchecked = [name for name in PANEL if name not in errors]
+    return {"rows": n, "tolerance": tolerance, "max_error": errors, "unchecked": unchecked,
+            "ok": not unchecked and all(e <= tolerance for e in errors.values())}
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # 可断点续算的批量计算
+#
+# 把整个病例库用所有公式重新算一遍要几个小时, 中途进程挂了就得从头再来. 这里把输入文件(CSV或者Excel)
+# 按固定行数切成编号的块, 每算完一块:
+#
+# 1. 结果写成 `chunk_000123.npz`
+# 2. 更新进度清单 `manifest.json`
+#
+# 两步都是先写临时文件再 `os.replace`, 不会留下写了一半的文件. 进程重启以后读清单, 从最后一个写完的块接着算.
+# 只用本地文件, 不需要数据库.
+#
+# 公式改了以后整个病例库要重新算一遍时, 给出 `cache` (IOL_cache.ResultCache 或者它的文件名):
+# 每一块每个公式的结果按公式的版本戳缓存, 没有改过的公式直接从缓存里读, 只有改过的公式重算.
+#
+# ```
+# run("registry.csv", "registry_job")          # 挂了以后再运行一次同样的命令就会接着算
+# export_csv("registry_job", "registry_results.csv")
+# run("registry.csv", "registry_job_v2", cache="registry_cache.sqlite")   # 部署新版本以后
+# ```
+
+# In[ ]:
+
+
+import json
+import os
+import time
+
+import numpy as np
+
+import IOL_cache
+import IOL_csv
+import validate_IOL
+
+
+MANIFEST = "manifest.json"
+
+
+def atomic_write(path, write):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _fingerprint(path):
+    st = os.stat(path)
+    return {"input": os.path.abspath(path), "input_size": st.st_size, "input_mtime_ns": st.st_mtime_ns}
+
+
+def _chunk_file(index):
+    return "chunk_%06d.npz" % index
+
+
+# ## 输入
+#
+# 根据扩展名选择 IOL_csv 或者 IOL_excel 的逐块读入.
+
+# In[ ]:
+
+
+def _iter_input(path, chunk_rows, skip_chunks):
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        import IOL_excel
+        yield from IOL_excel.iter_chunks(path, chunk_rows=chunk_rows, skip_chunks=skip_chunks)
+    else:
+        yield from IOL_csv.iter_chunks(path, chunk_rows, skip_chunks)
+
+
+def _count_rows(path):
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        from openpyxl import load_workbook
+        wb = load_workbook(path, read_only=True)
+        try:
+            n = wb.worksheets[0].max_row
+        finally:
+            wb.close()
+        return max(n - 1, 0) if n else None
+    return IOL_csv.count_rows(path)
+
+
+# ## 进度清单
+
+# In[ ]:
+
+
+def load_manifest(job_dir):
+    path = os.path.join(job_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_manifest(job_dir, manifest):
+    manifest["updated"] = time.time()
+    data = json.dumps(manifest, indent=1).encode("utf-8")
+    atomic_write(os.path.join(job_dir, MANIFEST), lambda f: f.write(data))
+
+
+def print_progress(p):
+    eta = "%.0f s" % p["eta_seconds"] if p["eta_seconds"] is not None else "?"
+    total = p["total_rows"] if p["total_rows"] is not None else "?"
+    print("chunk %d: %d/%s rows, %.0f rows/s, ETA %s"
+          % (p["chunk"], p["rows_done"], total, p["rows_per_second"], eta))
+
+
+# ## 运行
+#
+# `max_chunks` 限制这一次最多算几块, 可以把一个大任务分几次跑完.
+
+# In[ ]:
+
+
+def run(input_path, job_dir, methods=None, chunk_rows=10000, progress=print_progress, max_chunks=None,
+        cache=None):
+    if isinstance(cache, str):
+        with IOL_cache.ResultCache(cache, max_bytes=None) as opened:
+            return run(input_path, job_dir, methods, chunk_rows, progress, max_chunks, opened)
+    os.makedirs(job_dir, exist_ok=True)
+    manifest = load_manifest(job_dir)
+    fingerprint = _fingerprint(input_path)
+    if manifest is None:
+        manifest = dict(fingerprint, chunk_rows=chunk_rows, methods=methods,
+                        chunks=[], rows_done=0, complete=False, started=time.time())
+        _save_manifest(job_dir, manifest)
+    else:
+        # 输入文件变了, 或者分块大小变了, 已经算好的块就对不上了
+        for key, value in fingerprint.items():
+            if manifest[key] != value:
+                raise ValueError("%s does not match the job in %s (%s changed); "
+                                 "use a new job directory" % (input_path, job_dir, key))
+        if manifest["chunk_rows"] != chunk_rows:
+            raise ValueError("job in %s was started with chunk_rows=%d"
+                             % (job_dir, manifest["chunk_rows"]))
+        if methods is not None and manifest["methods"] is not None and list(methods) != manifest["methods"]:
+            raise ValueError("job in %s was started with methods %s" % (job_dir, manifest["methods"]))
+    if manifest["complete"]:
+        return manifest
+
+    total_rows = _count_rows(input_path)
+    done_before = manifest["rows_done"]
+    t0 = time.perf_counter()
+    index = len(manifest["chunks"])
+    processed = 0
+    finished = True
+    for header, columns, numbers in _iter_input(input_path, chunk_rows, index):
+        if max_chunks is not None and processed >= max_chunks:
+            finished = False
+            break
+        t_chunk = time.perf_counter()
+        hits = cache.hits if cache is not None else 0
+        results, codes = validate_IOL.checked_panel(columns, manifest["methods"], cache)
+        if manifest["methods"] is None:
+            manifest["methods"] = list(results)
+        arrays = {"row": numbers, "errors": codes}
+        arrays.update(results)
+        atomic_write(os.path.join(job_dir, _chunk_file(index)), lambda f: np.savez(f, **arrays))
+
+        manifest["chunks"].append({"index": index, "file": _chunk_file(index), "rows": len(numbers),
+                                   "seconds": time.perf_counter() - t_chunk,
+                                   "cached_methods": (cache.hits - hits) if cache is not None else 0})
+        manifest["rows_done"] += len(numbers)
+        _save_manifest(job_dir, manifest)
+
+        index += 1
+        processed += 1
+        if progress is not None:
+            elapsed = time.perf_counter() - t0
+            rate = (manifest["rows_done"] - done_before) / elapsed if elapsed > 0 else 0.0
+            remaining = None
+            if total_rows is not None and rate > 0:
+                remaining = max(total_rows - manifest["rows_done"], 0) / rate
+            progress({"chunk": index - 1, "rows_done": manifest["rows_done"], "total_rows": total_rows,
+                      "rows_per_second": rate, "eta_seconds": remaining})
+
+    if finished:
+        manifest["complete"] = True
+        _save_manifest(job_dir, manifest)
+    return manifest
+
+
+# ## 取出结果
+
+# In[ ]:
+
+
+def iter_results(job_dir):
+    manifest = load_manifest(job_dir)
+    if manifest is None:
+        return
+    for chunk in manifest["chunks"]:
+        with np.load(os.path.join(job_dir, chunk["file"])) as data:
+            yield {k: data[k] for k in data.files}
+
+
+def load_results(job_dir):
+    parts = list(iter_results(job_dir))
+    if not parts:
+        return {}
+    return {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+
+
+def export_csv(job_dir, out_path):
+    mode = "w"
+    for part in iter_results(job_dir):
+        part["errors"] = np.array([", ".join(validate_IOL.describe_errors(c)) for c in part["errors"]])
+        IOL_csv.write_csv(out_path, part, mode)
+        mode = "a"
+    return out_path
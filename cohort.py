@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # 模拟病例生成
+#
+# 真实病人的数据不能拿来做压力测试, 而项目里只有控件上的几个默认值(AL 23.5, K 44, A 118.4).
+# 这里用numpy一次生成大批"看起来像真的"角膜屈光手术后白内障病人, 各个量之间有合理的相关性:
+#
+# * 近视手术史的眼轴长, 远视手术史的眼轴短: `AL = AL_mean - AL_per_D × RXpre + 噪声`
+# * 屈光手术前的K(Kpre)与眼轴负相关
+# * 手术改变的屈光度 SIRC = RXpre - 术后残留的等效球镜, 近视为负 (与 IOL_calc.py 中控件的默认值 SIRC=-3 一致)
+# * 术后K: `Kpost = Kpre + K_per_SIRC × SIRC + 噪声`, 近视手术以后角膜变平; 最平坦的K(Kflat)再减去一半的角膜散光
+# * 前表面半径 rF = R = 337.5/Kpost; 后表面不受手术影响, 由术前的前表面半径按比例得到
+# * 近视手术中央角膜变薄, 大约每屈光度 `CCT_per_D` μm
+# * 前房深度与眼轴正相关
+#
+# 输出的列名与 batch_IOL.PANEL 一致, 可以直接写成CSV/Excel, 交给 IOL_excel / batch_job 计算.
+
+# In[ ]:
+
+
+import numpy as np
+
+import IOL_csv
+
+
+# ## 分布参数
+#
+# 都可以在调用时用关键字参数覆盖, 比如 `generate(10**6, myopic_fraction=0.5)`.
+
+# In[ ]:
+
+
+DEFAULTS = {
+    "myopic_fraction": 0.8,           # 近视手术史的比例, 其余为远视手术史
+    "myopic_RXpre": (-10.0, -1.0),    # 术前等效球镜的范围 D
+    "hyperopic_RXpre": (0.75, 5.0),
+    "residual_sd": 0.5,               # 术后残留等效球镜的标准差 D
+    "AL_mean": 23.6, "AL_per_D": 0.33, "AL_sd": 0.7,
+    "Kpre_mean": 43.8, "Kpre_per_AL": -0.4, "Kpre_sd": 1.3,
+    "K_per_SIRC": 0.8, "Kpost_sd": 0.4, "cyl_sd": 0.6,
+    "rB_ratio": 0.82, "rB_sd": 0.12,
+    "CCT_mean": 545.0, "CCT_sd": 33.0, "CCT_per_D": 12.0,
+    "ACD_mean": 3.1, "ACD_per_AL": 0.2, "ACD_sd": 0.3,
+    "A_constants": (118.4, 118.7, 118.9, 119.0, 119.2),
+    "targets": (-0.5, -0.25, 0.0, -1.0),
+    "target_weights": (0.6, 0.2, 0.1, 0.1),
+}
+
+
+def _params(overrides):
+    unknown = set(overrides) - set(DEFAULTS)
+    if unknown:
+        raise TypeError("unknown cohort parameter(s): %s" % ", ".join(sorted(unknown)))
+    p = dict(DEFAULTS)
+    p.update(overrides)
+    return p
+
+
+# ## 生成
+
+# In[ ]:
+
+
+def generate(n, seed=None, rng=None, **overrides):
+    p = _params(overrides)
+    if rng is None:
+        rng = np.random.default_rng(seed)
+
+    myopic = rng.random(n) < p["myopic_fraction"]
+    lo, hi = p["myopic_RXpre"]
+    RXpre = rng.uniform(lo, hi, n)
+    lo, hi = p["hyperopic_RXpre"]
+    RXpre = np.where(myopic, RXpre, rng.uniform(lo, hi, n))
+    SIRC = RXpre - rng.normal(0, p["residual_sd"], n)
+
+    AL = p["AL_mean"] - p["AL_per_D"] * RXpre + rng.normal(0, p["AL_sd"], n)
+    Kpre = p["Kpre_mean"] + p["Kpre_per_AL"] * (AL - p["AL_mean"]) + rng.normal(0, p["Kpre_sd"], n)
+    Kpost = Kpre + p["K_per_SIRC"] * SIRC + rng.normal(0, p["Kpost_sd"], n)
+    # K是K1,K2的平均值, 最平坦的K比平均值小一半的角膜散光
+    Kflat = Kpost - np.abs(rng.normal(0, p["cyl_sd"], n)) / 2
+
+    rF = 337.5 / Kpost
+    rB = p["rB_ratio"] * (337.5 / Kpre) + rng.normal(0, p["rB_sd"], n)
+    CCT = (rng.normal(p["CCT_mean"], p["CCT_sd"], n)
+           - np.where(myopic, p["CCT_per_D"] * np.abs(SIRC), 0))
+    ACD = np.clip(p["ACD_mean"] + p["ACD_per_AL"] * (AL - p["AL_mean"]) + rng.normal(0, p["ACD_sd"], n),
+                  1.8, 4.8)
+
+    A = rng.choice(np.asarray(p["A_constants"], dtype=np.float64), n)
+    weights = np.asarray(p["target_weights"], dtype=np.float64)
+    Rx = rng.choice(np.asarray(p["targets"], dtype=np.float64), n, p=weights / weights.sum())
+
+    return {"AL": AL, "K": Kpost, "Kpre": Kpre, "Kpost": Kpost, "Kflat": Kflat, "ACD": ACD, "A": A, "Rx": Rx,
+            "R": rF, "rF": rF, "rB": rB, "CCT": CCT, "SIRC": SIRC, "RXpre": RXpre}
+
+
+def iter_cohort(n, chunk_rows=100000, seed=None, **overrides):
+    # 逐块生成, 内存只占一块. 同样的 seed 和 chunk_rows 得到同样的数据.
+    rng = np.random.default_rng(seed)
+    for start in range(0, n, chunk_rows):
+        yield generate(min(chunk_rows, n - start), rng=rng, **overrides)
+
+
+# ## 写成批量计算的输入文件
+#
+# 扩展名是 .xlsx 的写Excel (write-only 模式), 其他的写CSV.
+
+# In[ ]:
+
+
+def write_cohort(path, n, chunk_rows=100000, seed=None, **overrides):
+    chunks = iter_cohort(n, chunk_rows, seed, **overrides)
+    if path.lower().endswith(".xlsx"):
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("patients")
+        header = None
+        for columns in chunks:
+            if header is None:
+                header = list(columns)
+                ws.append(header)
+            for row in zip(*(columns[k].tolist() for k in header)):
+                ws.append(row)
+        wb.save(path)
+    else:
+        mode = "w"
+        for columns in chunks:
+            IOL_csv.write_csv(path, columns, mode)
+            mode = "a"
+    return path
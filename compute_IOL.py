@@ -106,7 +106,7 @@ def HOFFER_Q(AL, K, ACD, Rx):
 #     CORRECTED CHAMBER DEPTH
     if AL<=23:
         M = +1; G = 28 
-    elif AL > 23:
+    else:
         M =-1;  G=23.5
     if AL > 31:
         AL = 31 
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # 角膜地形图 → 角膜屈光力
+#
+# BESSt 和 Gaussian optics formula 只接收一个前表面半径 rF, 一个后表面半径 rB 和一个CCT.
+# 但Pentacam这类Scheimpflug设备导出的是整张图: 前后表面每一点的曲率半径, 以及每一点的角膜厚度.
+#
+# 这里把整张图按照中央 3mm, 4mm 等区域求平均:
+#
+# * `rF_3mm`, `rB_3mm`: 区域内前后表面曲率半径的平均值, 可以直接作为BESSt的 rF, rB
+# * `CCT`: 中央 `cct_zone` 直径内角膜厚度的平均值 μm
+# * `TCP_3mm`: 区域内每一点按照Gaussian optics(厚透镜)公式算出的角膜屈光力, 再求平均
+# * `ACCP_3mm`: 区域内前表面按1.3375换算的屈光力的平均值, 即Awwad方法里的 $ACCP_{3mm}$
+#
+# 地形图文件格式: `.npy` 数组, 形状 (眼数, 3, ny, nx), 三个通道依次是前表面曲率半径 mm, 后表面曲率半径 mm,
+# 角膜厚度 μm, 图的中心是角膜顶点, 相邻两点间距 `spacing` mm. 测不到的点填NaN.
+# 文件用 memory map 打开, 只读取中央区域所在的那几行, 几千张图也不会一次读进内存.
+
+# In[ ]:
+
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+import batch_IOL
+
+
+ANTERIOR, POSTERIOR, PACHYMETRY = 0, 1, 2
+
+
+# ## 读写地形图文件
+
+# In[ ]:
+
+
+def save_maps(path, maps):
+    maps = np.asarray(maps, dtype=np.float32)
+    if maps.ndim == 3:
+        maps = maps[np.newaxis]
+    out = open_memmap(path, mode="w+", dtype=np.float32, shape=maps.shape)
+    out[:] = maps
+    out.flush()
+    del out
+
+
+def create_maps(path, n_eyes, ny, nx):
+    # 逐张写入大文件时用: 先开一个空的memory map, 再一张一张填进去
+    return open_memmap(path, mode="w+", dtype=np.float32, shape=(n_eyes, 3, ny, nx))
+
+
+def load_maps(path):
+    maps = np.load(path, mmap_mode="r")
+    if maps.ndim == 3:
+        maps = maps[np.newaxis]
+    if maps.ndim != 4 or maps.shape[1] != 3:
+        raise ValueError("map file must have shape (eyes, 3, ny, nx), got %s" % (maps.shape,))
+    return maps
+
+
+# ## 区域掩码
+#
+# 掩码只和图的大小、点间距有关, 对同一台设备导出的所有图都一样, 算一次就够了.
+# 为了少读数据, 先求出最大区域所在的矩形范围, 掩码也只在这个范围内.
+
+# In[ ]:
+
+
+def zone_masks(shape, spacing, zones):
+    ny, nx = shape
+    y = (np.arange(ny) - (ny - 1) / 2) * spacing
+    x = (np.arange(nx) - (nx - 1) / 2) * spacing
+    radius = max(zones) / 2
+    # 区域超出图的范围时, 圆只剩下图内的部分, 平均值就不再是这个区域的了
+    half_extent = min(ny - 1, nx - 1) / 2 * spacing
+    if radius > half_extent + 1e-9:
+        raise ValueError("zone of %.2f mm does not fit a %d x %d map with %.3f mm spacing "
+                         "(covers %.2f mm)" % (max(zones), ny, nx, spacing, 2 * half_extent))
+    rows = np.nonzero(np.abs(y) <= radius)[0]
+    cols = np.nonzero(np.abs(x) <= radius)[0]
+    if rows.size == 0 or cols.size == 0:
+        raise ValueError("zone of %.2f mm is smaller than the map spacing" % max(zones))
+    box = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+    r2 = y[box[0], np.newaxis]**2 + x[np.newaxis, box[1]]**2
+    return box, {z: r2 <= (z / 2)**2 for z in zones}
+
+
+# ## 每一点的角膜屈光力
+#
+# Gaussian optics(厚透镜):
+# $$
+# P=\frac{n_1-n_0}{r_1}+\frac{n_2-n_1}{r_2}-\frac{d}{n_1}\times\frac{n_1-n_0}{r_1}\times\frac{n_2-n_1}{r_2}
+# $$
+# $n_0=1$ 空气, $n_1=1.376$ 角膜, $n_2=1.336$ 房水, 半径和厚度都换算成米.
+
+# In[ ]:
+
+
+def thick_lens_power(r1, r2, pachymetry, n1=1.376, n2=1.336, n0=1.0):
+    Fa = (n1 - n0) / (r1 / 1000)
+    Fp = (n2 - n1) / (r2 / 1000)
+    d = pachymetry / 1000000
+    return Fa + Fp - d / n1 * Fa * Fp
+
+
+def _zone_mean(values, valid, mask):
+    m = valid & mask
+    count = m.sum(axis=(-2, -1))
+    total = np.where(m, values, 0).sum(axis=(-2, -1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / count, np.nan)
+
+
+# ## 区域平均
+
+# In[ ]:
+
+
+def zone_powers(maps, spacing, zones=(3.0, 4.0), cct_zone=1.0, chunk=32):
+    if not hasattr(maps, "ndim"):
+        maps = load_maps(maps)
+    n, _, ny, nx = maps.shape
+    all_zones = tuple(sorted(set(zones) | {cct_zone}))
+    box, masks = zone_masks((ny, nx), spacing, all_zones)
+
+    names = ["CCT"]
+    for z in zones:
+        names += ["rF_%gmm" % z, "rB_%gmm" % z, "TCP_%gmm" % z, "ACCP_%gmm" % z]
+    out = {name: np.empty(n) for name in names}
+
+    for i in range(0, n, chunk):
+        j = min(i + chunk, n)
+        # 只从文件里读中央区域
+        block = np.asarray(maps[i:j, :, box[0], box[1]], dtype=np.float64)
+        rF = block[:, ANTERIOR]
+        rB = block[:, POSTERIOR]
+        pachy = block[:, PACHYMETRY]
+        valid = np.isfinite(rF) & np.isfinite(rB) & np.isfinite(pachy) & (rF > 0) & (rB > 0) & (pachy > 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            tcp = thick_lens_power(rF, rB, pachy)
+            accp = 337.5 / rF
+        out["CCT"][i:j] = _zone_mean(pachy, valid, masks[cct_zone])
+        for z in zones:
+            m = masks[z]
+            out["rF_%gmm" % z][i:j] = _zone_mean(rF, valid, m)
+            out["rB_%gmm" % z][i:j] = _zone_mean(rB, valid, m)
+            out["TCP_%gmm" % z][i:j] = _zone_mean(tcp, valid, m)
+            out["ACCP_%gmm" % z][i:j] = _zone_mean(accp, valid, m)
+    return out
+
+
+# ## 直接代入BESSt
+#
+# `biometry` 是其他的列(AL, ACD, A, Rx), 与地形图一一对应. 默认用3mm区域的平均半径.
+
+# In[ ]:
+
+
+def besst_columns(powers, zone=3.0):
+    return {"rF": powers["rF_%gmm" % zone],
+            "rB": powers["rB_%gmm" % zone],
+            "CCT": powers["CCT"]}
+
+
+def besst_from_maps(maps, spacing, biometry, zone=3.0, cct_zone=1.0, chunk=32):
+    powers = zone_powers(maps, spacing, zones=(zone,), cct_zone=cct_zone, chunk=chunk)
+    columns = batch_IOL.canonical_columns(biometry)
+    columns.update(besst_columns(powers, zone))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        iol = batch_IOL.BESST(columns["rF"], columns["rB"], columns["CCT"],
+                              columns["AL"], columns["ACD"], columns["A"], columns["Rx"])
+    return iol, powers
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # 不分配内存的 SRK/T 和 Double-K SRK/T
+#
+# batch_IOL 里的数组公式写起来和标量版本一样, 但每一步 (Lc, Rmm, C1, Rc, S1..S5 ...) 都会新建一个临时数组.
+# 一块一块地流式计算大批数据时, 反复申请和释放这些数组比计算本身还花时间.
+#
+# 这里的版本:
+#
+# * 调用者事先建好一个 `Workspace`, 大小等于一块的行数, 所有中间结果都放在里面
+# * 结果写到调用者给的 `out` 数组
+# * 每一步都用 numpy 的 `out=` 参数原地计算
+#
+# 所以在稳定的流式循环里, 不再申请任何数组. 结果与 batch_IOL 相同(只有运算顺序带来的1e-13级别差别).
+#
+# ```
+# ws = Workspace(100000)
+# out = np.empty(100000)
+# for chunk in chunks:
+#     n = len(chunk["AL"])
+#     SRK_T_into(chunk["AL"], chunk["K"], chunk["A"], chunk["Rx"], out[:n], ws)
+# ```
+
+# In[ ]:
+
+
+import time
+import tracemalloc
+
+import numpy as np
+
+
+class Workspace:
+    NAMES = ("Lc", "Rmm", "Rpost", "C1", "Rc", "L0", "ACDE", "S1", "S2", "S3", "S4", "S5", "t")
+
+    def __init__(self, size, dtype=np.float64):
+        self.size = size
+        self.dtype = np.dtype(dtype)
+        self.arrays = {name: np.empty(size, dtype=self.dtype) for name in self.NAMES}
+        self.mask = np.empty(size, dtype=bool)
+        self._n = None
+        self._views = None
+
+    def views(self, n):
+        # 最后一块可能不满, 用前n个元素的视图. 同样的n直接用上次的视图, 连视图对象也不再新建.
+        if n != self._n:
+            if n > self.size:
+                raise ValueError("chunk of %d rows does not fit a workspace of %d" % (n, self.size))
+            self._views = {name: a[:n] for name, a in self.arrays.items()}
+            self._views["mask"] = self.mask[:n]
+            self._n = n
+        return self._views
+
+
+# ## 共用的步骤
+
+# In[ ]:
+
+
+def _corrected_length(AL, w):
+    # Lc = AL if AL<=24.2 else -3.446 + 1.716*AL - 0.0237*AL**2
+    Lc, t, m = w["Lc"], w["t"], w["mask"]
+    np.multiply(AL, AL, out=t)
+    t *= -0.0237
+    np.multiply(AL, 1.716, out=Lc)
+    Lc += t
+    Lc -= 3.446
+    np.less_equal(AL, 24.2, out=m)
+    np.copyto(Lc, AL, where=m)
+    return Lc
+
+
+def _elp(K, A, w):
+    # ACDE = H + (0.62467*A - 68.74709) - 3.3357, H = R - sqrt(max(R**2 - C1**2/4, 0)), R = 337.5/K
+    Lc, Rmm, C1, Rc, ACDE, t = w["Lc"], w["Rmm"], w["C1"], w["Rc"], w["ACDE"], w["t"]
+    np.divide(337.5, K, out=Rmm)
+    np.multiply(Lc, 0.58412, out=C1)
+    np.multiply(K, 0.098, out=t)
+    C1 += t
+    C1 -= 5.40948
+    np.multiply(Rmm, Rmm, out=Rc)
+    np.multiply(C1, C1, out=t)
+    t *= 0.25
+    Rc -= t
+    np.maximum(Rc, 0, out=Rc)
+    np.sqrt(Rc, out=Rc)
+    np.subtract(Rmm, Rc, out=Rc)
+    np.multiply(A, 0.62467, out=ACDE)
+    ACDE -= 68.74709
+    ACDE += Rc
+    ACDE -= 3.3357
+    return ACDE
+
+
+def _vergence(AL, R, REFt, out, w):
+    # R 是用于聚散度计算的角膜半径(Double-K 中为术后的半径)
+    L0, ACDE = w["L0"], w["ACDE"]
+    S1, S2, S3, S4, S5, t = w["S1"], w["S2"], w["S3"], w["S4"], w["S5"], w["t"]
+    np.multiply(AL, -0.02029, out=L0)
+    L0 += AL
+    L0 += 0.65696
+    np.subtract(L0, ACDE, out=S1)
+    np.multiply(R, 1.336, out=S2)
+    np.multiply(ACDE, 0.333, out=t)
+    S2 -= t
+    np.multiply(R, 1.336, out=S3)
+    np.multiply(L0, 0.333, out=t)
+    S3 -= t
+    np.multiply(S3, 12, out=S4)
+    np.multiply(L0, R, out=t)
+    S4 += t
+    np.multiply(S2, 12, out=S5)
+    np.multiply(ACDE, R, out=t)
+    S5 += t
+    # IOL = 1336*(S3 - 0.001*REFt*S4) / (S1*(S2 - 0.001*REFt*S5))
+    np.multiply(S4, REFt, out=t)
+    t *= -0.001
+    t += S3
+    t *= 1336
+    np.multiply(S5, REFt, out=S4)
+    S4 *= -0.001
+    S4 += S2
+    S4 *= S1
+    np.divide(t, S4, out=out)
+    return out
+
+
+# ## SRK/T, Double-K SRK/T
+
+# In[ ]:
+
+
+def SRK_T_into(AL, Kd, A, REFt, out, ws):
+    w = ws.views(out.shape[0])
+    _corrected_length(AL, w)
+    _elp(Kd, A, w)
+    return _vergence(AL, w["Rmm"], REFt, out, w)
+
+
+def Double_K_SRK_T_into(AL, Kpre, Kpost, A, REFt, out, ws):
+    w = ws.views(out.shape[0])
+    _corrected_length(AL, w)
+    _elp(Kpre, A, w)
+    np.divide(337.5, Kpost, out=w["Rpost"])
+    return _vergence(AL, w["Rpost"], REFt, out, w)
+
+
+# ## 内存分配的测试
+#
+# 用 tracemalloc 记录每一块计算时内存的峰值比计算前多了多少. numpy 申请的数组内存也会被 tracemalloc 记录.
+# 只要峰值的增量小于一个"块大小"的数组, 就说明这一块的计算中没有申请过任何块大小的临时数组.
+
+# In[ ]:
+
+
+def allocation_benchmark(chunk_rows=100000, n_chunks=20, seed=0):
+    import batch_IOL
+    rng = np.random.default_rng(seed)
+    AL = rng.uniform(20, 32, chunk_rows)
+    Kpre = rng.uniform(38, 50, chunk_rows)
+    Kpost = Kpre - rng.uniform(0, 6, chunk_rows)
+    A = rng.uniform(115, 121, chunk_rows)
+    REFt = rng.uniform(-3, 1, chunk_rows)
+    array_bytes = AL.nbytes
+
+    ws = Workspace(chunk_rows)
+    out = np.empty(chunk_rows)
+
+    def naive():
+        batch_IOL.SRK_T(AL, Kpost, A, REFt)
+        batch_IOL.Double_K_SRK_T(AL, Kpre, Kpost, A, REFt)
+
+    def inplace():
+        SRK_T_into(AL, Kpost, A, REFt, out, ws)
+        Double_K_SRK_T_into(AL, Kpre, Kpost, A, REFt, out, ws)
+
+    report = {"chunk_rows": chunk_rows, "array_bytes": array_bytes}
+    for name, step in (("naive", naive), ("inplace", inplace)):
+        step()  # 第一次调用建好视图
+        tracemalloc.start()
+        peaks = []
+        t0 = time.perf_counter()
+        for _ in range(n_chunks):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            step()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+        seconds = time.perf_counter() - t0
+        tracemalloc.stop()
+        report[name] = {"peak_bytes_per_chunk": peaks,
+                        "max_peak_arrays": max(peaks) / array_bytes,
+                        "seconds_per_chunk": seconds / n_chunks}
+    return report
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # 预先计算的列线图(nomogram)
+#
+# 在生物测量仪上实时给出结果时, 与其每次都代入公式, 不如事先把公式在一个密集的网格上
+# (AL × K × A常数 × ..., 有SIRC的公式再加上SIRC)全部算好, 存成一个紧凑的二进制文件.
+# 查询时只要找到所在的网格, 对周围 2^d 个格点做多线性插值, 计算量是固定的, 与公式本身多复杂无关.
+#
+# 网格都是等间距的, 所以格点的位置直接算出来, 不需要查找. 插值不够准的格子在建表时标记出来,
+# 落在这些格子里的点直接代入公式计算. 建表的时候还会在网格内随机取点, 与直接代入公式的结果比较,
+# 记下插值误差的估计(随机点中的最大值和99%分位数).
+
+# In[ ]:
+
+
+import json
+import os
+
+import numpy as np
+
+import batch_IOL
+import IOL_cache
+
+
+# ## 默认的网格
+#
+# (最小值, 最大值, 点数). 一个公式的每个参数都是网格的一个维度, 除非在 `fixed` 里给出了固定值.
+# BESSt 有7个输入, Double_K_SIRC, Masket, Latkany 有6个, 全部做成网格太大了(Double_K_SIRC约1.2GB), 默认不建表;
+# 需要的话可以给出更粗的网格, 或者在 `fixed` 里固定其中几个(比如目标屈光度Rx).
+#
+# SRK/T一类的公式在 "K很陡 + 眼轴长" 的区域里, 角膜高度的开方项接近0, 导数趋于无穷大, 插值误差在这里最大
+# (默认网格下SRK/T可以到0.9D, Double-K SRK/T 1.5D). 等间距的网格在这里加密不了, 所以建表时在步长减半的网格上
+# 检查每个格子的 3^d 个点(格点、棱的中点、面的中心、格子中心), 有一个点的插值误差超过 `tolerance`, 这个格子连同它
+# 周围一圈格子都标记为"不可插值", 查询时这些格子里的点直接用公式计算.
+# 这只是检查了有限的点, 不是误差的上界. 表里记的 max_error / p99_error 也是随机取点的估计: 默认网格和
+# tolerance=0.01D 下, 每张表取 2×10^6 个随机点, 插值部分的最大误差约0.006-0.009D.
+# 直接计算的格子: Double-K 一类约17-21%, Haigis约26%, SRK/T约10%, Hoffer Q, Haigis-L, Shammas没有(见 build_all 的报告).
+
+# In[ ]:
+
+
+DEFAULT_AXES = {
+    "AL": (20.0, 32.0, 61),
+    "K": (35.0, 50.0, 31),
+    "Kpre": (38.0, 50.0, 25),
+    "Kpost": (33.0, 48.0, 31),
+    "A": (115.0, 121.0, 25),
+    "Rx": (-3.0, 1.0, 9),
+    "ACD": (2.0, 4.5, 11),
+    "R": (6.75, 9.6, 20),
+    "SIRC": (-10.0, 4.0, 29),
+}
+
+DEFAULT_METHODS = [name for name in batch_IOL.PANEL
+                   if name not in ("BESST", "Double_K_SIRC", "Masket", "Latkany", "Latkany_flattest")]
+
+MAGIC = b"IOLNOMO1"
+
+
+# ## 多线性插值
+
+# In[ ]:
+
+
+class Nomogram:
+    def __init__(self, method, axes, fixed, values, version=None, max_error=None, p99_error=None,
+                 invalid=None, tolerance=None):
+        self.method = method
+        self.axes = [(name, float(lo), float(hi), int(n)) for name, lo, hi, n in axes]
+        self.fixed = dict(fixed)
+        self.values = values
+        self.version = version
+        self.max_error = max_error
+        self.p99_error = p99_error
+        # 不可插值的格子, 每个格子一位, 按C顺序压缩成 uint8 (np.packbits)
+        self.invalid = invalid
+        self.tolerance = tolerance
+
+    @property
+    def cell_shape(self):
+        return tuple(n - 1 for _, _, _, n in self.axes)
+
+    @property
+    def invalid_fraction(self):
+        if self.invalid is None:
+            return 0.0
+        return float(np.unpackbits(np.asarray(self.invalid))[:int(np.prod(self.cell_shape))].mean())
+
+    @property
+    def names(self):
+        return [name for name, _, _, _ in self.axes]
+
+    def predict(self, columns=None, fallback=True, **kwargs):
+        # 输入列名与 batch_IOL.PANEL 相同; 超出网格范围的点返回NaN.
+        # 建表时固定了的参数(fixed)可以不给; 给了的话必须与建表时的值相同, 否则返回NaN.
+        # 落在不可插值的格子里的点直接用公式计算, fallback=False 时返回NaN
+        columns = batch_IOL.canonical_columns(dict(columns or {}, **kwargs))
+        idx = []
+        frac = []
+        inside = True
+        for name, value in self.fixed.items():
+            if name in columns:
+                inside = inside & np.isclose(np.asarray(columns[name], dtype=np.float64), value,
+                                             rtol=0, atol=1e-9)
+        for name, lo, hi, n in self.axes:
+            q = np.asarray(columns[name], dtype=np.float64)
+            step = (hi - lo) / (n - 1)
+            pos = (q - lo) / step
+            with np.errstate(invalid="ignore"):
+                inside = inside & (pos >= 0) & (pos <= n - 1)
+            i = np.clip(np.floor(np.nan_to_num(pos)), 0, n - 2).astype(np.intp)
+            idx.append(i)
+            frac.append(pos - i)
+        shape = np.broadcast(inside, *idx).shape
+        result = np.zeros(shape)
+        d = len(self.axes)
+        for corner in range(2**d):
+            weight = np.ones(shape)
+            point = []
+            for k in range(d):
+                bit = (corner >> k) & 1
+                weight = weight * (frac[k] if bit else 1 - frac[k])
+                point.append(idx[k] + bit)
+            result += weight * self.values[tuple(point)]
+        result = np.where(inside, result, np.nan)
+        if self.invalid is not None:
+            flat = np.ravel_multi_index(np.broadcast_arrays(*idx), self.cell_shape)
+            bad = inside & ((np.asarray(self.invalid)[flat >> 3] >> (7 - (flat & 7))) & 1).astype(bool)
+            if bad.any():
+                result[bad] = self._direct(columns, bad, shape) if fallback else np.nan
+        return result
+
+    def _direct(self, columns, rows, shape):
+        func, args = batch_IOL.PANEL[self.method]
+        values = [self.fixed[a] if a not in columns
+                  else np.broadcast_to(np.asarray(columns[a], dtype=np.float64), shape)[rows]
+                  for a in args]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return func(*values)
+
+    # ## 文件格式
+    #
+    # MAGIC, 4字节的表头长度, JSON表头, 然后是C顺序的float32数组, 最后是不可插值格子的位图.
+    # 读的时候数组和位图都用memory map打开.
+
+    def save(self, path):
+        header = json.dumps({"method": self.method,
+                             "axes": self.axes,
+                             "fixed": self.fixed,
+                             "version": self.version,
+                             "max_error": self.max_error,
+                             "p99_error": self.p99_error,
+                             "tolerance": self.tolerance,
+                             "invalid": self.invalid is not None}).encode("utf-8")
+        offset = len(MAGIC) + 4 + len(header)
+        header += b" " * (-offset % 16)
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(np.uint32(len(header)).tobytes())
+            f.write(header)
+            f.write(np.ascontiguousarray(self.values, dtype=np.float32).tobytes())
+            if self.invalid is not None:
+                f.write(np.asarray(self.invalid, dtype=np.uint8).tobytes())
+
+    def is_current(self):
+        # 公式改过以后, 表要重建
+        return self.version == IOL_cache.formula_version(batch_IOL.PANEL[self.method][0])
+
+
+def load(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a nomogram file" % path)
+        size = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+        header = json.loads(f.read(size).decode("utf-8"))
+    shape = tuple(n for _, _, _, n in header["axes"])
+    offset = len(MAGIC) + 4 + size
+    values = np.memmap(path, dtype=np.float32, mode="r", offset=offset, shape=shape)
+    invalid = None
+    if header.get("invalid"):
+        cells = int(np.prod([n - 1 for n in shape]))
+        invalid = np.memmap(path, dtype=np.uint8, mode="r", offset=offset + values.nbytes,
+                            shape=((cells + 7) // 8,))
+    return Nomogram(header["method"], header["axes"], header["fixed"], values,
+                    header["version"], header["max_error"], header["p99_error"],
+                    invalid, header.get("tolerance"))
+
+
+# ## 建表
+#
+# 按照第一个维度一层一层地算, 每一层用 batch_IOL 的数组版本一次算完, 内存占用只有一层那么大.
+
+# In[ ]:
+
+
+def _grid(lo, hi, n):
+    return np.linspace(lo, hi, n)
+
+
+def _refine(a, axis):
+    # 沿一个维度, 在每两个相邻的值之间插入它们的平均值: n 个值变成 2n-1 个
+    n = a.shape[axis]
+    shape = list(a.shape)
+    shape[axis] = 2 * n - 1
+    out = np.empty(shape, dtype=a.dtype)
+    even = [slice(None)] * a.ndim
+    odd = [slice(None)] * a.ndim
+    even[axis] = slice(0, None, 2)
+    odd[axis] = slice(1, None, 2)
+    out[tuple(even)] = a
+    out[tuple(odd)] = (a.take(range(n - 1), axis=axis) + a.take(range(1, n), axis=axis)) / 2
+    return out
+
+
+def _pool(mask, axis):
+    # 半步网格上的 2n-1 个点 -> n-1 个格子: 格子 i 包括半步网格上的 2i, 2i+1, 2i+2
+    n = mask.shape[axis]
+    return (mask.take(range(0, n - 2, 2), axis=axis) | mask.take(range(1, n - 1, 2), axis=axis)
+            | mask.take(range(2, n, 2), axis=axis))
+
+
+def _dilate(mask):
+    # 每个标记了的格子, 把它在每个维度上前后相邻的格子也标记上
+    out = mask.copy()
+    for k in range(mask.ndim):
+        ahead = [slice(None)] * mask.ndim
+        behind = [slice(None)] * mask.ndim
+        ahead[k] = slice(1, None)
+        behind[k] = slice(None, -1)
+        out[tuple(ahead)] |= mask[tuple(behind)]
+        out[tuple(behind)] |= mask[tuple(ahead)]
+    return out
+
+
+def invalid_cells(method, spec, fixed, values, tolerance):
+    # 在步长减半的网格上比较 插值 与 直接计算: 每个格子检查 3^d 个点, 即格点、各条棱的中点、各个面的中心和格子中心.
+    # 一层一层地算, 第一个维度上相邻的两个格子共用中间那一层.
+    func, args = batch_IOL.PANEL[method]
+    fine = [_refine(_grid(lo, hi, n), 0) for _, lo, hi, n in spec]
+    mesh = np.meshgrid(*fine[1:], indexing="ij", sparse=True)
+    mask = np.empty(tuple(n - 1 for _, _, _, n in spec), dtype=bool)
+
+    def layer(j):
+        i, odd = divmod(j, 2)
+        interp = np.asarray(values[i:i + 1 + odd], dtype=np.float64).mean(axis=0)
+        for k in range(interp.ndim):
+            interp = _refine(interp, k)
+        columns = dict(fixed)
+        columns[spec[0][0]] = fine[0][j]
+        for (name, _, _, _), m in zip(spec[1:], mesh):
+            columns[name] = m
+        bad = ~(np.abs(interp - func(*(columns[a] for a in args))) <= tolerance)
+        for k in range(bad.ndim):
+            bad = _pool(bad, k)
+        return bad
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        below = layer(0)
+        for i in range(mask.shape[0]):
+            above = layer(2 * i + 2)
+            mask[i] = below | layer(2 * i + 1) | above
+            below = above
+    return _dilate(mask)
+
+
+def build(method, axes=None, fixed=None, n_check=100000, seed=0, tolerance=0.01):
+    func, args = batch_IOL.PANEL[method]
+    fixed = {k: v for k, v in (fixed or {}).items() if k in args}
+    axes = dict(axes or {})
+    spec = []
+    for a in args:
+        if a in fixed:
+            continue
+        lo, hi, n = axes.get(a, DEFAULT_AXES.get(a, (None, None, None)))
+        if n is None:
+            raise ValueError("no grid for %r in %s; give it in axes or fixed" % (a, method))
+        spec.append((a, lo, hi, n))
+
+    grids = [_grid(lo, hi, n) for _, lo, hi, n in spec]
+    values = np.empty(tuple(n for _, _, _, n in spec), dtype=np.float32)
+    mesh = np.meshgrid(*grids[1:], indexing="ij", sparse=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for i, first in enumerate(grids[0]):
+            columns = dict(fixed)
+            columns[spec[0][0]] = first
+            for (name, _, _, _), m in zip(spec[1:], mesh):
+                columns[name] = m
+            values[i] = func(*(columns[a] for a in args))
+
+    table = Nomogram(method, spec, fixed, values, IOL_cache.formula_version(func))
+    if tolerance is not None:
+        table.invalid = np.packbits(invalid_cells(method, spec, fixed, values, tolerance).ravel())
+        table.tolerance = tolerance
+    if n_check:
+        errors = interpolation_error(table, n_check, seed)
+        errors = errors[np.isfinite(errors)]
+        table.max_error = float(errors.max()) if errors.size else None
+        table.p99_error = float(np.percentile(errors, 99)) if errors.size else None
+    return table
+
+
+def interpolation_error(table, n=100000, seed=0):
+    # 网格内随机取点, 插值结果与直接计算的差. 不可插值的格子里的点是NaN. 取点之外的误差可能更大
+    rng = np.random.default_rng(seed)
+    func, args = batch_IOL.PANEL[table.method]
+    columns = dict(table.fixed)
+    for name, lo, hi, _ in table.axes:
+        columns[name] = rng.uniform(lo, hi, n)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        direct = func(*(columns[a] for a in args))
+    return np.abs(table.predict(columns, fallback=False) - direct)
+
+
+def build_all(directory, methods=DEFAULT_METHODS, fixed=None, **kwargs):
+    # 每个公式一个文件 <directory>/<method>.nomo, 返回每个公式的误差
+    os.makedirs(directory, exist_ok=True)
+    report = {}
+    for method in methods:
+        table = build(method, fixed=fixed, **kwargs)
+        table.save(os.path.join(directory, method + ".nomo"))
+        report[method] = {"shape": table.values.shape,
+                          "max_error": table.max_error,
+                          "p99_error": table.p99_error,
+                          "invalid_fraction": table.invalid_fraction}
+    return report
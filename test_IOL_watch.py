@@ -0,0 +1,73 @@
+import csv
+import os
+
+import numpy as np
+
+import batch_IOL
+import IOL_watch
+
+
+HEADER = "lens,AL,K,A,Rx\n"
+
+
+def read_results(out_dir):
+    rows = []
+    for name in sorted(os.listdir(out_dir)):
+        if name.startswith("IOL_results_"):
+            with open(os.path.join(out_dir, name), newline="", encoding="utf-8") as f:
+                rows += list(csv.DictReader(f))
+    return rows
+
+
+def test_watcher_incremental(tmp_path):
+    watch_dir = tmp_path / "exports"
+    out_dir = tmp_path / "results"
+    watch_dir.mkdir()
+    lens = tmp_path / "lens_constants.csv"
+    lens.write_text("lens,A,a0,a1,a2\nSN60WF,118.7,,,\n", encoding="utf-8")
+    export = watch_dir / "biometer.csv"
+    export.write_text(HEADER + "sn60wf,23.5,44,,-0.5\n", encoding="utf-8")
+
+    w = IOL_watch.Watcher(str(watch_dir), str(out_dir), lens_constants=str(lens))
+    assert [r["rows"] for r in w.poll()] == [1]
+    assert w.poll() == []
+
+    # 追加一个完整的行和一个还没写完的行: 只处理完整的那一行
+    with open(export, "a", encoding="utf-8") as f:
+        f.write("SN60WF,24.0,43,119.0,0\n")
+        f.write("SN60WF,25.0,4")
+    assert [r["rows"] for r in w.poll()] == [1]
+
+    with open(export, "a", encoding="utf-8") as f:
+        f.write("2,118.4,-1\n")
+    assert [r["rows"] for r in w.poll()] == [1]
+
+    rows = read_results(str(out_dir))
+    assert [r["row"] for r in rows] == ["2", "3", "4"]
+    expected = batch_IOL.SRK_T(np.array([23.5, 24.0, 25.0]), np.array([44.0, 43.0, 42.0]),
+                               np.array([118.7, 119.0, 118.4]), np.array([-0.5, 0.0, -1.0]))
+    # 第一行的A常数从晶体常数表里查到, 其他两行用表格里给出的A常数
+    np.testing.assert_allclose([float(r["SRK_T"]) for r in rows], expected)
+    assert all(r["errors"] == "" for r in rows)
+
+    # 重启以后不重复计算
+    restarted = IOL_watch.Watcher(str(watch_dir), str(out_dir), lens_constants=str(lens))
+    assert restarted.poll() == []
+    assert len(read_results(str(out_dir))) == 3
+
+
+def test_watcher_bad_files(tmp_path):
+    watch_dir = tmp_path / "exports"
+    watch_dir.mkdir()
+    (watch_dir / "broken.xlsx").write_bytes(b"not a workbook")
+    (watch_dir / "~$broken.xlsx").write_bytes(b"lock")
+    (watch_dir / "ok.csv").write_text(HEADER + ",23.5,44,118.4,-0.5\n", encoding="utf-8")
+
+    w = IOL_watch.Watcher(str(watch_dir), str(tmp_path / "results"), settle=0)
+    results = {r["file"]: r for r in w.poll()}
+    assert set(results) == {"broken.xlsx", "ok.csv"}
+    assert "error" in results["broken.xlsx"]
+    assert results["ok.csv"]["rows"] == 1
+    assert "error" in w.state["broken.xlsx"]
+    # 没有改动的坏文件不再重试
+    assert w.poll() == []
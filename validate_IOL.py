@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # 批量数据校验
+#
+# 病历里抄错、漏填的数据很常见: K填成0, 眼轴填成了230, 前房深度空着... 标量公式遇到这种数据,
+# 要么除以0报错, 要么悄悄算出一个没有意义的数.
+#
+# 这里在计算之前, 对一整批数据一次性检查:
+#
+# * 每一列是否在生理范围之内 (同时也保证了公式里的分母不为0, 开方不为负)
+# * 每个公式需要的列是否齐全
+#
+# 得到每一行的错误掩码. 公式只在合格的行上计算, 不合格的行结果为NaN, 不需要逐行 try/except.
+
+# In[ ]:
+
+
+import numpy as np
+
+import batch_IOL
+import IOL_cache
+
+
+# ## 生理范围
+#
+# 范围取得比较宽, 只用来挡住明显的录入错误, 不是临床上的正常值.
+
+# In[ ]:
+
+
+RANGES = {
+    "AL": (14.0, 40.0),     # 眼轴 mm
+    "K": (25.0, 65.0),      # 角膜曲率 D
+    "Kpre": (25.0, 65.0),
+    "Kpost": (25.0, 65.0),
+    "ACD": (1.0, 6.5),      # 前房深度 mm
+    "A": (110.0, 125.0),    # A常数
+    "Rx": (-15.0, 15.0),    # 目标屈光度 D
+    "R": (5.0, 11.0),       # 角膜曲率半径 mm
+    "rF": (5.0, 11.0),      # 角膜前表面曲率半径 mm
+    "rB": (4.0, 10.0),      # 角膜后表面曲率半径 mm
+    "CCT": (300.0, 800.0),  # 中央角膜厚度 μm
+    "a0": (-5.0, 5.0),      # Haigis 常数, 空着的用默认值
+    "a1": (0.0, 1.0),
+    "a2": (0.0, 1.0),
+    "SIRC": (-20.0, 15.0),  # 屈光手术引起的屈光度变化 D
+    "RXpre": (-20.0, 15.0), # 屈光手术前的等效球镜 D
+    "Kflat": (25.0, 65.0),  # 最平坦的K D
+}
+
+# 个别公式对某一列的范围与上面不同. Haigis 中 ACD=0 表示没有测量, 用眼轴估计;
+# 其他公式 (包括以 Hoffer Q 为基础的 BESST, Masket, Latkany) ACD 必须是测量值;
+# Masket, Latkany 只有远视手术史的行需要 ACD (batch_IOL.HYPEROPIC_ONLY).
+METHOD_RANGES = {
+    "Haigis": {"ACD": (0.0, 6.5)},
+    "Haigis_L": {"ACD": (0.0, 6.5)},
+}
+
+# 可以空着的列 (空着表示使用默认值)
+NULLABLE = {"a0", "a1", "a2"}
+
+# 每一列对应错误码里的一位
+ERROR_BITS = {name: 1 << i for i, name in enumerate(RANGES)}
+DOMAIN_BIT = 1 << len(RANGES)
+
+
+def describe_errors(code):
+    # 错误码 -> 出错的列名
+    names = [name for name, bit in ERROR_BITS.items() if code & bit]
+    if code & DOMAIN_BIT:
+        names.append("domain")
+    return names
+
+
+# ## 校验
+
+# In[ ]:
+
+
+def column_errors(columns):
+    # 返回每行的错误码, 错误码的每一位对应一列.
+    columns = batch_IOL.canonical_columns(columns)
+    n = None
+    codes = None
+    for name, values in columns.items():
+        if name not in RANGES:
+            continue
+        values = np.asarray(values, dtype=np.float64)
+        if codes is None:
+            n = values.shape[0]
+            codes = np.zeros(n, dtype=np.int64)
+        codes |= np.where(_out_of_range(name, values, RANGES[name]), ERROR_BITS[name], 0)
+    if codes is None:
+        codes = np.zeros(0, dtype=np.int64)
+    return codes
+
+
+def _out_of_range(name, values, limits):
+    lo, hi = limits
+    with np.errstate(invalid="ignore"):
+        bad = ~((values >= lo) & (values <= hi))
+    if name in NULLABLE:
+        bad &= ~np.isnan(values)
+    return bad
+
+
+def method_masks(columns, codes, methods=None):
+    # 每个公式: 这一行是否可以计算. METHOD_RANGES 里的列不看错误码, 按这个公式自己的范围重新检查;
+    # HYPEROPIC_ONLY 里的列只检查远视的行
+    columns = batch_IOL.canonical_columns(columns)
+    if methods is None:
+        methods = batch_IOL.available_methods(columns)
+    masks = {}
+    for name in methods:
+        _, args = batch_IOL.PANEL[name]
+        own = METHOD_RANGES.get(name, {})
+        partial, sign = batch_IOL.HYPEROPIC_ONLY.get(name, (None, None))
+        bits = 0
+        for a in args + batch_IOL.OPTIONAL.get(name, ()):
+            if a not in own and a != partial:
+                bits |= ERROR_BITS.get(a, 0)
+        mask = (codes & bits) == 0
+        for a, limits in own.items():
+            if a in columns:
+                mask &= ~_out_of_range(a, np.asarray(columns[a], dtype=np.float64), limits)
+        if partial is not None:
+            with np.errstate(invalid="ignore"):
+                hyperopic = np.asarray(columns[sign], dtype=np.float64) > 0
+            if partial in columns:
+                hyperopic &= (codes & ERROR_BITS[partial]) != 0
+            mask &= ~hyperopic
+        masks[name] = mask
+    return masks
+
+
+def validate(columns, methods=None):
+    codes = column_errors(columns)
+    return codes, method_masks(columns, codes, methods)
+
+
+# ## 只在合格的行上计算
+#
+# 先把合格的行挑出来(压缩成连续数组), 算完再放回原来的位置. 算出来仍然不是有限数的(理论上在上面的
+# 范围内不会出现), 记上 `domain` 错误.
+#
+# 给出 `cache` (IOL_cache.ResultCache) 时, 每个公式在这一块上的结果按 (公式, 版本戳, 合格的行的输入) 缓存.
+
+# In[ ]:
+
+
+def checked_panel(columns, methods=None, cache=None):
+    columns = batch_IOL.canonical_columns(columns)
+    if methods is None:
+        methods = batch_IOL.available_methods(columns)
+    codes, masks = validate(columns, methods)
+    n = codes.shape[0]
+    results = {}
+    digests = {}
+    for name in methods:
+        ok = masks[name]
+        out = np.full(n, np.nan)
+        if ok.any():
+            func, args = batch_IOL.PANEL[name]
+            needed = tuple(a for a in args + batch_IOL.OPTIONAL.get(name, ()) if a in columns)
+            subset = {a: np.asarray(columns[a], dtype=np.float64)[ok] for a in needed}
+            value = None
+            if cache is not None:
+                # 整列的hash加上这个公式合格的行的掩码, 相当于 subset 的hash
+                for a in needed:
+                    if a not in digests:
+                        digests[a] = IOL_cache.array_digest(np.asarray(columns[a], dtype=np.float64))
+                inputs = {a: digests[a] for a in needed}
+                inputs["rows"] = IOL_cache.array_digest(np.packbits(ok))
+                key = IOL_cache.array_key(func, inputs)
+                value = cache.get(key)
+            if value is None:
+                value = batch_IOL.formula_panel(subset, [name])[name]
+                if cache is not None:
+                    cache.put(key, func, value, commit=False)
+            out[ok] = value
+        bad = ok & ~np.isfinite(out)
+        codes |= np.where(bad, DOMAIN_BIT, 0)
+        out[bad] = np.nan
+        results[name] = out
+    if cache is not None:
+        cache.commit()
+    return results, codes
+
+
+# ## Masket, Latkany 的各个变体
+#
+# 角膜屈光手术后的病人, 把 Masket, Latkany, Latkany_flattest 和它们的基础公式 SRK/T, Hoffer Q 并排输出,
+# 与 checked_panel 一样先校验. 缺少输入列的变体不输出.
+
+# In[ ]:
+
+
+CORRECTIONS = ("SRK_T", "Hoffer_Q", "Masket", "Latkany", "Latkany_flattest")
+
+
+def direct_corrections(columns):
+    columns = batch_IOL.canonical_columns(columns)
+    available = batch_IOL.available_methods(columns)
+    return checked_panel(columns, [name for name in CORRECTIONS if name in available])
+
+
+def summary(codes):
+    # 每一种错误出现了多少行
+    counts = {"rows": int(codes.shape[0]), "valid": int((codes == 0).sum())}
+    for name, bit in list(ERROR_BITS.items()) + [("domain", DOMAIN_BIT)]:
+        k = int(((codes & bit) != 0).sum())
+        if k:
+            counts[name] = k
+    return counts